@@ -10,6 +10,25 @@ import signal
 import atexit
 import threading
 import pymongo
+import hashlib
+import collections
+import dataclasses
+import queue
+import asyncio
+import random
+import io
+import heapq
+import itertools
+import socketserver
+import contextlib
+import contextvars
+import zlib
+import sys
+import tempfile
+import urllib.parse
+import concurrent.futures
+import difflib
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 from telebot.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -21,10 +40,88 @@ MONGODB_URI = os.getenv("MONGODB_URI")
 FREE_LIMIT = 30
 SUPPORT_USERNAME = "@uagptpredlozhkabot"
 AUTOSAVE_INTERVAL = 300
-MAX_HISTORY = 5
-
-user_data = {}
-promo_codes = {
+SAVE_DEBOUNCE = float(os.getenv("SAVE_DEBOUNCE", 2))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 3600))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 1000))
+SEARCH_CACHE_MONGO = os.getenv("SEARCH_CACHE_MONGO", "1") == "1"
+# Пошук по сайтах шардами паралельно; SEARCH_FANOUT=0 повертає один запит з усіма сайтами
+SEARCH_FANOUT = os.getenv("SEARCH_FANOUT", "1") == "1"
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", 4))
+SEARCH_POOL_SIZE = int(os.getenv("SEARCH_POOL_SIZE", 16))
+# Локальний індекс згенерованих карток фільмів: повторні запити за назвою обходяться без пошуку й Gemini
+MOVIE_INDEX = os.getenv("MOVIE_INDEX", "1") == "1"
+MOVIE_INDEX_SIZE = int(os.getenv("MOVIE_INDEX_SIZE", 20000))
+MOVIE_INDEX_MIN_SCORE = float(os.getenv("MOVIE_INDEX_MIN_SCORE", 0.85))
+# Короткі назви ("тор", "ким") від однієї букви відрізняються вже на ~15%, тому для них лише точний збіг
+MOVIE_INDEX_EXACT_LEN = int(os.getenv("MOVIE_INDEX_EXACT_LEN", 5))
+MOVIE_INDEX_TTL = int(os.getenv("MOVIE_INDEX_TTL", 30 * 86400))
+# Анонсовані фільми (наступний рік і далі) оновлюються частіше: дати й трейлери змінюються
+MOVIE_INDEX_UPCOMING_TTL = int(os.getenv("MOVIE_INDEX_UPCOMING_TTL", 86400))
+# Нічний прогрів популярних запитів про фільми (година за Києвом, 0-23; -1 вимикає)
+PREFETCH_HOUR = int(os.getenv("PREFETCH_HOUR", 5))
+PREFETCH_TOP_N = int(os.getenv("PREFETCH_TOP_N", 20))
+# Скільки викликів API (запити Custom Search + генерації Gemini) дозволено за один прогрів
+PREFETCH_BUDGET = int(os.getenv("PREFETCH_BUDGET", 100))
+PREFETCH_TIERS = os.getenv("PREFETCH_TIERS", "free").split(",")
+# Прогріті результати пошуку мають дожити до пікових годин
+PREFETCH_SEARCH_TTL = int(os.getenv("PREFETCH_SEARCH_TTL", 18 * 3600))
+TRENDING_DAYS = int(os.getenv("TRENDING_DAYS", 3))
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "threads")
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 16))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", 500))
+RUNTIME = os.getenv("RUNTIME", "sync")
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_POOL_SIZE", 100))
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", 32))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 5))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", 3))
+UPSTREAM_MAX_BACKOFF = float(os.getenv("UPSTREAM_MAX_BACKOFF", 8))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 30))
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+TELEGRAM_MESSAGE_LIMIT = 4096
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 1800))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 2000))
+SNIPPET_TTL = int(os.getenv("SNIPPET_TTL", 7 * 86400))
+SNIPPET_CACHE_SIZE = int(os.getenv("SNIPPET_CACHE_SIZE", 5000))
+# Шаблони, відповіді на які кешуються (код не кешуємо за замовчуванням)
+RESPONSE_CACHE_KINDS = set(os.getenv("RESPONSE_CACHE_KINDS", "general,movie").split(","))
+# Скільки останніх реплік (користувача й бота) зберігати; старіші стискаються в підсумок
+HISTORY_LIMIT = 20
+CONTEXT_TOKENS_FREE = int(os.getenv("CONTEXT_TOKENS_FREE", 1000))
+CONTEXT_TOKENS_PREMIUM = int(os.getenv("CONTEXT_TOKENS_PREMIUM", 4000))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 300))
+SUMMARIZE_WITH_GEMINI = os.getenv("SUMMARIZE_WITH_GEMINI", "1") == "1"
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 50000))
+USERS_PAGE_SIZE = 20
+NOTIFY_PREMIUM_EXPIRY = os.getenv("NOTIFY_PREMIUM_EXPIRY", "1") == "1"
+QUOTA_ATOMIC = os.getenv("QUOTA_ATOMIC", "1") == "1"
+BURST_LIMIT = int(os.getenv("BURST_LIMIT", 5))
+BURST_WINDOW = float(os.getenv("BURST_WINDOW", 10))
+# Режим вебхука: якщо задано WEBHOOK_URL, бот приймає оновлення по HTTP і може працювати в кількох репліках
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_PORT = int(os.getenv("PORT", 8080))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+SETTINGS_POLL_INTERVAL = float(os.getenv("SETTINGS_POLL_INTERVAL", 15))
+# Як довго кешований користувач вважається актуальним, якщо його можуть змінювати інші репліки
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30 if WEBHOOK_URL else 0))
+# Розсилка: Telegram дозволяє ~30 повідомлень на секунду на бота, частину лишаємо для звичайних відповідей
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 20))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", 100))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", 5))
+BROADCAST_LEASE = float(os.getenv("BROADCAST_LEASE", 300))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 5))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 10))
+# Локальний журнал для режиму без MongoDB (порожній JOURNAL_DIR вимикає)
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "bot_journal")
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", 64 * 1024 * 1024))
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", 1000))
+
+DEFAULT_PROMO_CODES = {
     "TEST1H": {"seconds": 3600, "uses_left": 50},
     "WELCOME1D": {"seconds": 86400, "uses_left": 100},
     "PREMIUM7D": {"seconds": 604800, "uses_left": 30},
@@ -32,20 +129,99 @@ promo_codes = {
 }
 BOT_ENABLED = True
 
-# Українські сайти що працюють без VPN
-BASE_MOVIE_SITES = [
-    "kinoukr.com", "film.ua", "kino-teatr.ua", "novyny.live", 
-    "telekritika.ua", "moviegram.com.ua", "kinofilms.ua",
-    "vgolos.com.ua", "kinozagolovkom.com.ua", "cinema.in.ua",
-    "imdb.com", "themoviedb.org", "letterboxd.com",
-    "myanimelist.net", "anilist.co", "anime-planet.com",
-    "rottentomatoes.com", "metacritic.com", "boxofficemojo.com"
+# Сайти для пошуку, згруповані в шарди за пріоритетом: спершу українські джерела, що працюють без VPN
+MOVIE_SITE_SHARDS = [
+    ["kinoukr.com", "film.ua", "kino-teatr.ua", "kinofilms.ua", "cinema.in.ua"],
+    ["novyny.live", "telekritika.ua", "moviegram.com.ua", "vgolos.com.ua", "kinozagolovkom.com.ua"],
+    ["imdb.com", "themoviedb.org", "letterboxd.com", "rottentomatoes.com", "metacritic.com", "boxofficemojo.com"],
+    ["myanimelist.net", "anilist.co", "anime-planet.com"],
 ]
+BASE_MOVIE_SITES = [site for shard in MOVIE_SITE_SHARDS for site in shard]
+
+# Пріоритет доменів у видачі (менше — вище); формат змінної: "kinoukr.com=0,film.ua=1"
+DEFAULT_DOMAIN_RANK = 5
+SEARCH_DOMAIN_PRIORITY = {
+    domain.strip(): int(rank) for domain, rank in (
+        item.split("=") for item in os.getenv(
+            "SEARCH_DOMAIN_PRIORITY", "kinoukr.com=0,film.ua=1,kino-teatr.ua=2,imdb.com=3,themoviedb.org=4"
+        ).split(",") if "=" in item
+    )
+}
+RUSSIAN_TLDS = (".ru", ".su", ".рф", ".xn--p1ai")
+RUSSIAN_DOMAIN_LABELS = {"yandex", "rambler", "kinopoisk", "tinkoff"}
 
 PREMIUM_MOVIE_SITES = BASE_MOVIE_SITES
 
 movie_keywords = ["фільм", "серіал", "аніме", "мультфільм", "movie", "anime", "series", "кіно", "фильм", "сюжет", "сюжету", "опис", "дивлюсь", "дивитись", "подивитись", "подивитися", "дивитися", "кінотеатр", "кінотеатру", "нетфлікс", "netflix", "дисней", "disney"]
 code_keywords = ["код", "html", "css", "js", "javascript", "python", "створи", "скрипт", "програма", "create", "program", "програмування", "кодування"]
+ukrainian_keywords = ["українськ", "украинск", "ukrainian"]
+# Жанрові ключові слова (порядок важливий: перший збіг визначає жанр)
+genre_keywords = {
+    "катастроф": "disaster catastrophe", "жахів": "horror scary", "комеді": "comedy funny",
+    "фантастик": "sci-fi fantasy", "бойовик": "action adventure", "драм": "drama emotional",
+    "мелодрам": "romance romantic", "трилер": "thriller suspense", "детектив": "detective mystery",
+    "аніме": "anime japanese", "історичн": "historical history", "біограф": "biography biographical"
+}
+
+KEYWORDS_FILE = os.getenv("KEYWORDS_FILE")
+if KEYWORDS_FILE:
+    try:
+        with open(KEYWORDS_FILE, encoding="utf-8") as f:
+            keyword_config = json.load(f)
+        movie_keywords = keyword_config.get("movie_keywords", movie_keywords)
+        code_keywords = keyword_config.get("code_keywords", code_keywords)
+        ukrainian_keywords = keyword_config.get("ukrainian_keywords", ukrainian_keywords)
+        genre_keywords = keyword_config.get("genre_keywords", genre_keywords)
+        print(f"✅ Ключові слова завантажено з {KEYWORDS_FILE}")
+    except Exception as e:
+        print(f"❌ Помилка завантаження ключових слів: {e}")
+
+@dataclasses.dataclass
+class Classification:
+    kind: str
+    genre: str = None
+    ukrainian: bool = False
+
+class KeywordClassifier:
+    """Зведена таблиця ключових слів: намір, жанр і мова за один прохід по тексту."""
+
+    def __init__(self, movie, code, genres, ukrainian):
+        self.genres = dict(genres)
+        self.genre_order = {keyword: i for i, keyword in enumerate(self.genres)}
+        tags = {}
+        for keyword in movie:
+            tags.setdefault(keyword.lower(), set()).add("movie")
+        for keyword in code:
+            tags.setdefault(keyword.lower(), set()).add("code")
+        for keyword in ukrainian:
+            tags.setdefault(keyword.lower(), set()).add("ukrainian")
+        for keyword in self.genres:
+            tags.setdefault(keyword.lower(), set()).add(("genre", keyword))
+        # Слово зайве, якщо воно містить коротше слово з тими ж тегами ("мультфільм" -> "фільм")
+        self.table = tuple(
+            (keyword, frozenset(keyword_tags)) for keyword, keyword_tags in tags.items()
+            if not any(other != keyword and other in keyword and keyword_tags <= other_tags for other, other_tags in tags.items())
+        )
+
+    def classify(self, text):
+        text = text.lower()
+        found = set()
+        for keyword, keyword_tags in self.table:
+            if keyword in text:
+                found |= keyword_tags
+        has_movie = "movie" in found
+        has_code = "code" in found
+        if has_movie and not has_code:
+            kind = "movie"
+        elif has_code and not has_movie:
+            kind = "code"
+        else:
+            kind = "general"
+        matched_genres = [tag[1] for tag in found if isinstance(tag, tuple)]
+        genre = self.genres[min(matched_genres, key=self.genre_order.get)] if matched_genres else None
+        return Classification(kind=kind, genre=genre, ukrainian="ukrainian" in found)
+
+keyword_classifier = KeywordClassifier(movie_keywords, code_keywords, genre_keywords, ukrainian_keywords)
 
 UKRAINE_TZ = pytz.timezone('Europe/Kiev')
 
@@ -64,38 +240,830 @@ try:
     client.admin.command('ping')
     db = client["telegram_bot"]
     users_collection = db["users"]
+    users_collection.create_index("premium.active")
+    users_collection.create_index("reset")
+    users_collection.create_index("username")
+    # Пошук за префіксом імені: регістронезалежний $regex не використовує межі індексу, тому зберігаємо нижній регістр
+    users_collection.create_index("username_lc")
+    daily_stats_collection = db["daily_stats"]
     promo_collection = db["promo_codes"]
+    promo_redemptions_collection = db["promo_redemptions"]
+    promo_redemptions_collection.create_index("code")
     bot_settings_collection = db["bot_settings"]
+    search_cache_collection = db["search_cache"]
+    snippets_collection = db["code_snippets"]
+    broadcasts_collection = db["broadcasts"]
+    movie_cards_collection = db["movie_cards"]
+    movie_queries_collection = db["movie_queries"]
     print("✅ Підключено до MongoDB Atlas!")
 except Exception as e:
     print(f"❌ Помилка підключення до MongoDB: {e}")
     print("⚠️  Бот працюватиме в режимі без бази даних")
     users_collection = None
+    daily_stats_collection = None
     promo_collection = None
+    promo_redemptions_collection = None
     bot_settings_collection = None
+    search_cache_collection = None
+    snippets_collection = None
+    broadcasts_collection = None
+    movie_cards_collection = None
+    movie_queries_collection = None
+
+def ensure_ttl_index(collection, field, seconds):
+    """Створює TTL-індекс; якщо строк змінили між деплоями, оновлює його через collMod.
+    Помилка індексу не має переводити бота в режим без бази даних."""
+    try:
+        collection.create_index(field, expireAfterSeconds=seconds)
+    except pymongo.errors.OperationFailure:
+        try:
+            collection.database.command("collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+            print(f"✅ TTL індексу {collection.name}.{field} змінено на {seconds} с")
+        except pymongo.errors.PyMongoError as e:
+            print(f"❌ Не вдалося оновити TTL-індекс {collection.name}.{field}: {e}")
+    except pymongo.errors.PyMongoError as e:
+        print(f"❌ Не вдалося створити TTL-індекс {collection.name}.{field}: {e}")
+
+if users_collection is not None:
+    ensure_ttl_index(search_cache_collection, "created_at", SEARCH_CACHE_TTL)
+    ensure_ttl_index(snippets_collection, "created_at", SNIPPET_TTL)
+    ensure_ttl_index(movie_queries_collection, "created_at", (TRENDING_DAYS + 1) * 86400)
+
+class JournalStore:
+    """Сховище для режиму без MongoDB: журнал змін з CRC32 на кожен запис і періодичний знімок стану.
+
+    Записи журналу містять абсолютні значення, тож повторне застосування після знімка нічого не псує.
+    """
+
+    def __init__(self, directory, compact_bytes):
+        self.directory = directory
+        self.journal_path = os.path.join(directory, "journal.log")
+        self.snapshot_path = os.path.join(directory, "snapshot.json")
+        self.compact_bytes = compact_bytes
+        self.lock = threading.Lock()
+        self.pending = []
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def encode(record):
+        payload = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return b"%08x " % zlib.crc32(payload) + payload + b"\n"
+
+    @staticmethod
+    def decode(line):
+        """Повертає запис або None, якщо рядок обірваний чи пошкоджений."""
+        if len(line) < 11 or not line.endswith(b"\n"):
+            return None
+        payload = line[9:-1]
+        try:
+            if int(line[:8], 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def recover(self):
+        """Читає знімок і застосовує журнал; обірваний хвіст журналу (збій під час запису) відкидається."""
+        started = time.monotonic()
+        state = {"users": {}, "promos": None, "redeemed": [], "settings": {}}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                checksum, payload = f.readline().strip(), f.read()
+            try:
+                if int(checksum, 16) != zlib.crc32(payload):
+                    raise ValueError("checksum")
+                snapshot = json.loads(payload)
+                state["users"] = {doc["_id"]: doc for doc in snapshot["users"]}
+                state.update(promos=snapshot["promos"], redeemed=snapshot["redeemed"], settings=snapshot["settings"])
+            except ValueError as e:
+                print(f"❌ Знімок пошкоджено ({e}), відновлюємо лише з журналу")
+        applied, good_offset = 0, 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    record = self.decode(line)
+                    if record is None:
+                        print(f"⚠️ Журнал обірвано на позиції {good_offset}, решту відкинуто")
+                        break
+                    self.apply(state, record)
+                    applied += 1
+                    good_offset += len(line)
+            os.truncate(self.journal_path, good_offset)
+        self.file = open(self.journal_path, "ab")
+        print(f"✅ Журнал: {len(state['users'])} користувачів, {applied} записів за {time.monotonic() - started:.2f}с")
+        return state
+
+    @staticmethod
+    def apply(state, record):
+        kind = record["t"]
+        if kind == "user":
+            state["users"].setdefault(record["id"], {"_id": record["id"]}).update(record["set"])
+        elif kind == "user_del":
+            state["users"].pop(record["id"], None)
+        elif kind == "promo":
+            state["promos"] = state["promos"] or {}
+            state["promos"][record["code"]] = record["data"]
+        elif kind == "promo_del":
+            (state["promos"] or {}).pop(record["code"], None)
+            state["redeemed"] = [r for r in state["redeemed"] if r[0] != record["code"]]
+        elif kind == "redeem":
+            state["redeemed"].append([record["code"], record["user"]])
+        elif kind == "settings":
+            state["settings"].update(record["set"])
+
+    def append(self, records):
+        with self.lock:
+            self.pending.extend(self.encode(record) for record in records)
+
+    def commit(self):
+        """Дописує накопичені записи одним write і одним fsync. Повертає розмір журналу."""
+        with self.lock:
+            if self.pending:
+                self.file.write(b"".join(self.pending))
+                self.pending.clear()
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            return self.file.tell()
+
+    def log(self, *records):
+        self.append(records)
+        self.commit()
+
+    def compact(self, build_state):
+        """Атомарно замінює знімок (tmp + fsync + rename) і очищає журнал. Стан будується під замком журналу."""
+        with self.lock:
+            if self.pending:
+                self.file.write(b"".join(self.pending))
+                self.pending.clear()
+            payload = json.dumps(build_state(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(b"%08x\n" % zlib.crc32(payload))
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            try:
+                dir_fd = os.open(self.directory, os.O_RDONLY)
+                os.fsync(dir_fd)
+                os.close(dir_fd)
+            except OSError:
+                pass
+            self.file.close()
+            self.file = open(self.journal_path, "wb")
+
+journal = JournalStore(JOURNAL_DIR, JOURNAL_COMPACT_BYTES) if users_collection is None and JOURNAL_DIR else None
+
+class TTLCache:
+    """LRU-кеш з часом життя записів і необов'язковим другим рівнем у MongoDB."""
+
+    def __init__(self, maxsize, ttl, collection=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.collection = collection
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key, value, expires):
+        with self.lock:
+            self.items[key] = (value, expires)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self.items[key]
+        if self.collection is not None:
+            try:
+                doc = self.collection.find_one({"_id": key})
+                if doc and doc["expires"] > now:
+                    self._store(key, doc["value"], doc["expires"])
+                    self.hits += 1
+                    return doc["value"]
+            except Exception as e:
+                print(f"❌ Помилка читання кешу: {e}")
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        expires = time.time() + ttl
+        self._store(key, value, expires)
+        if self.collection is not None:
+            # TTL-індекс у MongoDB рахує час від created_at, тож довший запис "створюємо" пізніше
+            created_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl - self.ttl)
+            try:
+                self.collection.update_one(
+                    {"_id": key},
+                    {"$set": {"value": value, "expires": expires, "created_at": created_at}},
+                    upsert=True
+                )
+            except Exception as e:
+                print(f"❌ Помилка запису кешу: {e}")
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+
+class Histogram:
+    """Гістограма з фіксованими межами кошиків (секунди)."""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def percentile(self, p):
+        with self.lock:
+            if not self.count:
+                return 0.0
+            target = self.count * p / 100
+            seen = 0
+            for i, c in enumerate(self.counts):
+                seen += c
+                if seen >= target:
+                    return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def render(self, name, labels=None):
+        """Рядки у текстовому форматі Prometheus (кошики накопичувальні)."""
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        label_text = ",".join(f'{key}="{value}"' for key, value in (labels or {}).items())
+        prefix = label_text + "," if label_text else ""
+        lines = []
+        cumulative = 0
+        for bound, c in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += c
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        suffix = f"{{{label_text}}}" if label_text else ""
+        lines.append(f"{name}_sum{suffix} {total}")
+        lines.append(f"{name}_count{suffix} {count}")
+        return lines
+
+# Етапи обробки повідомлення, тривалість яких вимірюється окремо
+STAGES = ("quota", "classification", "search", "context", "generation", "send", "persistence")
+stage_latency = {stage: Histogram() for stage in STAGES}
+request_latency = Histogram()
+gemini_usage = collections.Counter()
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """Тривалості етапів одного повідомлення; повільні запити логуються одним JSON-рядком."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.started = time.monotonic()
+        self.spans = {}
+
+    def finish(self):
+        total = time.monotonic() - self.started
+        request_latency.observe(total)
+        if total >= SLOW_REQUEST_SECONDS:
+            spans = {stage: round(value, 3) for stage, value in self.spans.items()}
+            print(json.dumps({"event": "slow_request", "user_id": self.user_id, "total": round(total, 3), "spans": spans}, ensure_ascii=False))
+
+@contextlib.contextmanager
+def span(stage):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        stage_latency[stage].observe(elapsed)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.spans[stage] = trace.spans.get(stage, 0) + elapsed
+
+@contextlib.contextmanager
+def traced(user_id):
+    trace = Trace(user_id)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+        trace.finish()
+
+def record_gemini_usage(result):
+    usage = result.get("usageMetadata") if isinstance(result, dict) else None
+    if not usage:
+        return
+    gemini_usage["prompt"] += usage.get("promptTokenCount", 0)
+    gemini_usage["output"] += usage.get("candidatesTokenCount", 0)
+    gemini_usage["responses"] += 1
+
+class UpstreamUnavailable(Exception):
+    pass
+
+class UpstreamClient:
+    """Пул з'єднань до одного upstream з повторами, backoff та запобіжником (circuit breaker)."""
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, name, read_timeout):
+        self.name = name
+        self.timeout = (UPSTREAM_CONNECT_TIMEOUT, read_timeout)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=UPSTREAM_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.latency = Histogram()
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.retries = 0
+        self.failures = 0
+        self.short_circuited = 0
+
+    def check_available(self):
+        if time.monotonic() < self.open_until:
+            self.short_circuited += 1
+            raise UpstreamUnavailable(f"{self.name} тимчасово недоступний, спробуйте пізніше")
+
+    def record(self, success, elapsed):
+        self.latency.observe(elapsed)
+        with self.lock:
+            if success:
+                self.consecutive_failures = 0
+                return
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= BREAKER_THRESHOLD:
+                self.open_until = time.monotonic() + BREAKER_COOLDOWN
+                print(f"⚠️ {self.name}: {self.consecutive_failures} помилок поспіль, пауза {BREAKER_COOLDOWN:.0f}с")
+
+    def backoff(self, attempt, headers):
+        retry_after = headers.get("Retry-After") if headers is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), UPSTREAM_MAX_BACKOFF)
+            except ValueError:
+                pass
+        return random.uniform(0, min(UPSTREAM_MAX_BACKOFF, 0.5 * 2 ** attempt))
+
+    def request(self, method, url, timeout=None, max_retries=UPSTREAM_MAX_RETRIES, **kwargs):
+        self.check_available()
+        for attempt in range(max_retries + 1):
+            started = time.monotonic()
+            response, error = None, None
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            success = response is not None and response.status_code not in self.RETRY_STATUSES
+            self.record(success, time.monotonic() - started)
+            if success:
+                return response
+            if attempt == max_retries or time.monotonic() < self.open_until:
+                break
+            self.retries += 1
+            time.sleep(self.backoff(attempt, response.headers if response is not None else None))
+        if response is not None:
+            return response
+        raise error
+
+    async def async_json(self, session, method, url, max_retries=UPSTREAM_MAX_RETRIES, **kwargs):
+        """Те саме, що request(), для aiohttp-сесії async-режиму. Повертає (HTTP-статус, JSON)."""
+        self.check_available()
+        for attempt in range(max_retries + 1):
+            started = time.monotonic()
+            status, data, headers, error = None, None, None, None
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    status, headers = response.status, response.headers
+                    data = await response.json(content_type=None)
+            except Exception as e:
+                error = e
+            success = status is not None and status not in self.RETRY_STATUSES
+            self.record(success, time.monotonic() - started)
+            if success:
+                return status, data
+            if attempt == max_retries or time.monotonic() < self.open_until:
+                break
+            self.retries += 1
+            await asyncio.sleep(self.backoff(attempt, headers))
+        if status is not None:
+            return status, data
+        raise error
+
+    def status(self):
+        state = "🔴" if time.monotonic() < self.open_until else "🟢"
+        return f"{state} {self.name}: p50 {self.latency.percentile(50)}с / p99 {self.latency.percentile(99)}с, повторів {self.retries}, помилок {self.failures}"
+
+gemini_client = UpstreamClient("Gemini", 25)
+search_client = UpstreamClient("Custom Search", 15)
+SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+search_pool = concurrent.futures.ThreadPoolExecutor(max_workers=SEARCH_POOL_SIZE, thread_name_prefix="search")
+search_stats = collections.Counter()
+
+gemini_ttft = Histogram()
+prompt_tokens = Histogram((250, 500, 1000, 2000, 4000, 8000, 16000))
+context_stats = collections.Counter()
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+snippet_store = TTLCache(SNIPPET_CACHE_SIZE, SNIPPET_TTL, snippets_collection)
+response_cache_hits = collections.Counter()
+
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, search_cache_collection if SEARCH_CACHE_MONGO else None)
+
+def parse_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if value:
+        return datetime.date.fromisoformat(value[:10])
+    return None
+
+def parse_datetime(value):
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = UKRAINE_TZ.localize(value)
+    return value
+
+@dataclasses.dataclass(slots=True)
+class UserRecord:
+    """Запис користувача з типізованими полями. Перетворення з/у документ MongoDB — лише тут."""
+    id: int
+    used: int = 0
+    reset: int = 0
+    premium_active: bool = False
+    premium_until: datetime.datetime = None
+    history: collections.deque = dataclasses.field(default_factory=lambda: collections.deque(maxlen=HISTORY_LIMIT))
+    free_used: bool = False
+    last_movie_query: str = None
+    last_code: str = None
+    username: str = None
+    first_name: str = None
+    last_name: str = None
+    summary: str = ""
+
+    FIELDS = ("used", "reset", "premium", "history", "free_used", "last_movie_query", "last_code", "username", "first_name", "last_name", "summary")
+    SHARED_FIELDS = ("used", "reset", "premium", "free_used")
+    # Розмова: перечитується перед кожною відповіддю, якщо реплік кілька
+    CONVERSATION_FIELDS = ("history", "summary", "last_code")
+
+    @classmethod
+    def from_doc(cls, doc):
+        premium = doc.get("premium") or {}
+        return cls(
+            id=doc["_id"],
+            used=doc.get("used", 0),
+            reset=parse_date(doc.get("reset")).toordinal() if doc.get("reset") else 0,
+            premium_active=bool(premium.get("active", False)),
+            premium_until=parse_datetime(premium.get("until")),
+            history=collections.deque((legacy_turn(turn) for turn in doc.get("history") or []), maxlen=HISTORY_LIMIT),
+            free_used=doc.get("free_used", False),
+            last_movie_query=doc.get("last_movie_query"),
+            last_code=doc.get("last_code"),
+            username=doc.get("username"),
+            first_name=doc.get("first_name"),
+            last_name=doc.get("last_name"),
+            summary=doc.get("summary") or "",
+        )
+
+    def field_value(self, field):
+        if field == "reset":
+            return datetime.date.fromordinal(self.reset).isoformat() if self.reset else None
+        if field == "premium":
+            return {"active": self.premium_active, "until": self.premium_until.isoformat() if self.premium_until else None}
+        if field == "history":
+            return list(self.history)
+        return getattr(self, field)
+
+    def to_doc(self):
+        doc = {field: self.field_value(field) for field in self.FIELDS}
+        doc["_id"] = self.id
+        doc["username_lc"] = username_lc(self.username)
+        return doc
+
+    def set_premium(self, active, until=None):
+        self.premium_active = active
+        self.premium_until = until
+
+def username_lc(username):
+    return username.lower() if username else None
+
+def legacy_turn(turn):
+    """Старі записи історії — рядки; у bot_data.json вони ще й з префіксами «👤: » / «🤖: »."""
+    if isinstance(turn, dict):
+        return turn
+    if turn.startswith("🤖: "):
+        return {"role": "model", "text": turn[3:]}
+    if turn.startswith("👤: "):
+        return {"role": "user", "text": turn[3:]}
+    return {"role": "user", "text": turn}
+
+class UserRepository:
+    """Користувачі підвантажуються з MongoDB за _id при першому зверненні й тримаються в обмеженому LRU."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.users = collections.OrderedDict()
+        self.evicted = {}
+        self.loaded = {}
+        self.lock = threading.RLock()
+
+    def get(self, user_id, default=None):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is not None:
+                self.users.move_to_end(user_id)
+                if not USER_CACHE_TTL or time.monotonic() - self.loaded.get(user_id, 0) < USER_CACHE_TTL:
+                    return user
+                self.loaded[user_id] = time.monotonic()
+        if user is not None:
+            self.refresh(user)
+            return user
+        with self.lock:
+            if user_id in self.evicted:
+                # Запис витіснено, але ще не збережено — повертаємо його разом з незбереженими змінами
+                user, fields, incs = self.evicted.pop(user_id)
+                restore_user_changes(user_id, fields, incs)
+                self._put(user)
+                return user
+        if users_collection is None:
+            return default
+        try:
+            doc = users_collection.find_one({"_id": user_id})
+        except Exception as e:
+            print(f"❌ Помилка завантаження користувача {user_id}: {e}")
+            return default
+        if doc is None:
+            return default
+        with self.lock:
+            return self.users.get(user_id) or self._put(UserRecord.from_doc(doc))
+
+    def refresh(self, user, fields=UserRecord.SHARED_FIELDS):
+        """Підтягує з бази поля, які можуть змінити інші репліки, якщо локально вони не змінені."""
+        if users_collection is None:
+            return
+        try:
+            doc = users_collection.find_one({"_id": user.id}, {field: 1 for field in fields})
+        except Exception as e:
+            print(f"❌ Помилка оновлення користувача {user.id}: {e}")
+            return
+        if doc is None:
+            return
+        fresh = UserRecord.from_doc(doc)
+        with dirty_lock:
+            local = dirty_user_fields.get(user.id, set()) | set(pending_user_incs.get(user.id, ()))
+            if "*" in local:
+                return
+            for field in fields:
+                if field in local:
+                    continue
+                if field == "premium":
+                    user.set_premium(fresh.premium_active, fresh.premium_until)
+                else:
+                    setattr(user, field, getattr(fresh, field))
+
+    def peek(self, user_id):
+        with self.lock:
+            return self.users.get(user_id)
+
+    def _put(self, user):
+        self.users[user.id] = user
+        self.users.move_to_end(user.id)
+        self.loaded[user.id] = time.monotonic()
+        # Без бази даних витісняти нікуди — тримаємо всіх у пам'яті
+        while users_collection is not None and len(self.users) > self.maxsize:
+            user_id, evicted_user = self.users.popitem(last=False)
+            self.loaded.pop(user_id, None)
+            fields, incs = take_user_changes(user_id)
+            if fields or incs:
+                self.evicted[user_id] = (evicted_user, fields, incs)
+                schedule_save()
+        return user
+
+    def take_evicted(self):
+        with self.lock:
+            evicted, self.evicted = self.evicted, {}
+        return evicted
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        user = self.get(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def __setitem__(self, user_id, user):
+        with self.lock:
+            self.evicted.pop(user_id, None)
+            self._put(user)
+
+    def __delitem__(self, user_id):
+        with self.lock:
+            self.users.pop(user_id, None)
+            self.evicted.pop(user_id, None)
+
+    def __len__(self):
+        return len(self.users)
+
+    def cached(self):
+        with self.lock:
+            return list(self.users.values())
+
+user_data = UserRepository(USER_CACHE_SIZE)
+
+def create_user(user_id, username=None, first_name=None, last_name=None, premium_active=False, premium_until=None):
+    user = UserRecord(
+        id=user_id, reset=current_day(), premium_active=premium_active, premium_until=premium_until,
+        username=username, first_name=first_name, last_name=last_name
+    )
+    user_data[user_id] = user
+    mark_user_dirty(user_id)
+    count_daily("new_users")
+    schedule_premium_expiry(user)
+    return user
+
+class PromoStore:
+    """Кожен промокод — окремий документ; використання списується умовним $inc, а запис погашення не дає використати код двічі."""
+
+    def __init__(self, collection, redemptions, defaults, journal=None):
+        self.collection = collection
+        self.redemptions = redemptions
+        self.journal = journal
+        # Без бази даних промокоди живуть лише в пам'яті процесу
+        self.codes = {code: dict(data) for code, data in defaults.items()}
+        self.redeemed = set()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Переносить коди зі старого спільного документа active_promos і засіває типові коди в порожню колекцію."""
+        legacy = self.collection.find_one({"_id": "active_promos"})
+        if legacy is not None:
+            codes = legacy.get("codes", {})
+        elif self.collection.estimated_document_count() == 0:
+            codes = self.codes
+        else:
+            codes = {}
+        if codes:
+            self.collection.bulk_write([
+                pymongo.UpdateOne({"_id": code}, {"$setOnInsert": {"seconds": data["seconds"], "uses_left": data["uses_left"]}}, upsert=True)
+                for code, data in codes.items()
+            ], ordered=False)
+        if legacy is not None:
+            self.collection.delete_one({"_id": "active_promos"})
+
+    def all(self):
+        if self.collection is None:
+            with self.lock:
+                return {code: dict(data) for code, data in self.codes.items()}
+        return {doc["_id"]: {"seconds": doc["seconds"], "uses_left": doc["uses_left"]} for doc in self.collection.find().sort("_id")}
+
+    def count(self):
+        if self.collection is None:
+            return len(self.codes)
+        return self.collection.estimated_document_count()
+
+    def add(self, code, seconds, uses):
+        if self.collection is None:
+            with self.lock:
+                self.codes[code] = {"seconds": seconds, "uses_left": uses}
+                self.log({"t": "promo", "code": code, "data": self.codes[code]})
+            return
+        self.collection.update_one({"_id": code}, {"$set": {"seconds": seconds, "uses_left": uses}}, upsert=True)
+
+    def remove(self, code):
+        if self.collection is None:
+            with self.lock:
+                self.redeemed = {r for r in self.redeemed if r[0] != code}
+                self.log({"t": "promo_del", "code": code})
+                return self.codes.pop(code, None) is not None
+        self.redemptions.delete_many({"code": code})
+        return self.collection.delete_one({"_id": code}).deleted_count > 0
+
+    def log(self, *records):
+        if self.journal is not None:
+            self.journal.log(*records)
+
+    def restore(self, codes, redeemed):
+        if codes is not None:
+            self.codes = codes
+        self.redeemed = {tuple(r) for r in redeemed}
+
+    def redeem(self, code, user_id):
+        """Повертає (статус, тривалість у секундах); статус: ok, invalid, exhausted або used."""
+        if self.collection is None:
+            with self.lock:
+                data = self.codes.get(code)
+                if data is None:
+                    return "invalid", None
+                if (code, user_id) in self.redeemed:
+                    return "used", None
+                if data["uses_left"] <= 0:
+                    return "exhausted", None
+                data["uses_left"] -= 1
+                self.redeemed.add((code, user_id))
+                self.log({"t": "promo", "code": code, "data": data}, {"t": "redeem", "code": code, "user": user_id})
+                return "ok", data["seconds"]
+        redemption_id = f"{code}:{user_id}"
+        try:
+            self.redemptions.insert_one({"_id": redemption_id, "code": code, "user_id": user_id, "at": get_ukraine_time().isoformat()})
+        except pymongo.errors.DuplicateKeyError:
+            return "used", None
+        try:
+            doc = self.collection.find_one_and_update(
+                {"_id": code, "uses_left": {"$gt": 0}}, {"$inc": {"uses_left": -1}},
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+        except Exception:
+            self.redemptions.delete_one({"_id": redemption_id})
+            raise
+        if doc is None:
+            self.redemptions.delete_one({"_id": redemption_id})
+            exists = self.collection.find_one({"_id": code}, {"_id": 1}) is not None
+            return ("exhausted" if exists else "invalid"), None
+        return "ok", doc["seconds"]
+
+promo_store = PromoStore(promo_collection, promo_redemptions_collection, DEFAULT_PROMO_CODES, journal)
+
+def journal_state():
+    return {
+        "users": [user.to_doc() for user in user_data.cached()],
+        "promos": promo_store.codes,
+        "redeemed": [list(r) for r in promo_store.redeemed],
+        "settings": {"enabled": BOT_ENABLED},
+    }
+
+def load_journal():
+    global BOT_ENABLED
+    try:
+        fresh = not os.path.exists(journal.snapshot_path)
+        state = journal.recover()
+        for doc in state["users"].values():
+            user = UserRecord.from_doc(doc)
+            user_data[user.id] = user
+            # Без MongoDB start_scheduler не бачить термінів преміуму — плануємо їх тут, прострочені знімаємо одразу
+            if user.premium_active and user.premium_until is not None:
+                if user.premium_until.timestamp() <= time.time():
+                    expire_premium(user.id, user.premium_until)
+                else:
+                    schedule_premium_expiry(user)
+        promo_store.restore(state["promos"], state["redeemed"])
+        BOT_ENABLED = state["settings"].get("enabled", True)
+        if fresh:
+            # Перший знімок фіксує типові промокоди, щоб журнал містив лише зміни відносно нього
+            journal.compact(journal_state)
+    except Exception as e:
+        print(f"❌ Помилка відновлення з журналу: {e}")
+
+def backfill_username_lc():
+    """Заповнює username_lc для записів, збережених до появи поля."""
+    try:
+        result = users_collection.update_many(
+            {"username": {"$type": "string"}, "username_lc": {"$exists": False}},
+            [{"$set": {"username_lc": {"$toLower": "$username"}}}]
+        )
+        if result.modified_count:
+            print(f"✅ username_lc заповнено для {result.modified_count} користувачів")
+    except Exception as e:
+        print(f"❌ Помилка заповнення username_lc: {e}")
 
 def load_data():
-    global user_data, promo_codes, BOT_ENABLED
+    global BOT_ENABLED
     if users_collection is None:
-        print("❌ MongoDB не підключено, пропускаємо завантаження даних")
+        if journal is not None:
+            load_journal()
+        else:
+            print("❌ MongoDB не підключено, пропускаємо завантаження даних")
         return
     try:
-        user_data = {}
-        for user in users_collection.find():
-            user_data[user['_id']] = user
-            if 'reset' in user and isinstance(user['reset'], str):
-                user_data[user['_id']]['reset'] = datetime.date.fromisoformat(user['reset'])
-            if 'premium' in user and 'until' in user['premium'] and user['premium']['until'] and isinstance(user['premium']['until'], str):
-                dt = datetime.datetime.fromisoformat(user['premium']['until'].replace('Z', '+00:00'))
-                if dt.tzinfo is None:
-                    dt = UKRAINE_TZ.localize(dt)
-                user_data[user['_id']]['premium']['until'] = dt
-        
-        promo_doc = promo_collection.find_one({"_id": "active_promos"})
-        if promo_doc:
-            promo_codes = promo_doc.get('codes', {})
-        else:
-            promo_collection.update_one({"_id": "active_promos"}, {"$set": {"codes": promo_codes}}, upsert=True)
+        promo_store.load()
+        movie_index.load()
+        backfill_username_lc()
         
         settings = bot_settings_collection.find_one({"_id": "main_settings"})
         if settings:
@@ -104,39 +1072,362 @@ def load_data():
             BOT_ENABLED = True
             bot_settings_collection.insert_one({"_id": "main_settings", "enabled": True})
             
-        print(f"✅ Завантажено {len(user_data)} користувачів з MongoDB")
-        print(f"✅ Завантажено {len(promo_codes)} промокодів")
+        print(f"✅ Користувачів у MongoDB: ~{users_collection.estimated_document_count()} (завантажуються за потребою)")
+        print(f"✅ Завантажено {promo_store.count()} промокодів")
+        print(f"✅ Карток фільмів в індексі: {len(movie_index.cards)}")
     except Exception as e:
         print(f"❌ Помилка завантаження даних: {e}")
 
 def get_ukraine_time():
     return datetime.datetime.now(UKRAINE_TZ)
 
+class Scheduler:
+    """Купа відкладених задач із підмінним годинником (clock), щоб задачі можна було тестувати без очікування."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def schedule(self, when, callback, *args):
+        with self.cond:
+            heapq.heappush(self.heap, (when, next(self.counter), callback, args))
+            self.cond.notify()
+
+    def run_pending(self):
+        """Виконує всі задачі, час яких настав. Повертає час наступної задачі або None."""
+        while True:
+            with self.cond:
+                if not self.heap:
+                    return None
+                if self.heap[0][0] > self.clock():
+                    return self.heap[0][0]
+                _, _, callback, args = heapq.heappop(self.heap)
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"❌ Помилка запланованої задачі: {e}")
+
+    def run_forever(self):
+        while True:
+            next_time = self.run_pending()
+            with self.cond:
+                timeout = None if next_time is None else max(0, next_time - self.clock())
+                self.cond.wait(timeout)
+
+    def start(self):
+        threading.Thread(target=self.run_forever, daemon=True).start()
+
+scheduler = Scheduler()
+
+def current_day():
+    """Номер поточної доби за київським часом; рахується щоразу, а не лише коли спрацює північна задача."""
+    return datetime.datetime.fromtimestamp(scheduler.clock(), UKRAINE_TZ).date().toordinal()
+
+def next_midnight(now_ts):
+    today = datetime.datetime.fromtimestamp(now_ts, UKRAINE_TZ).date()
+    midnight = UKRAINE_TZ.localize(datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time()))
+    return midnight.timestamp()
+
+def reset_daily_quotas():
+    today = datetime.date.fromordinal(current_day())
+    if users_collection is not None:
+        # Спершу записуємо лічильники за минулу добу, потім скидаємо всіх одним запитом
+        save_data()
+        try:
+            result = users_collection.update_many({"reset": {"$ne": today.isoformat()}}, {"$set": {"used": 0, "reset": today.isoformat()}})
+            print(f"✅ Денний ліміт скинуто для {result.modified_count} користувачів")
+        except Exception as e:
+            print(f"❌ Помилка скидання лімітів: {e}")
+    for user in user_data.cached():
+        if user.reset != today.toordinal():
+            user.used = 0
+            user.reset = today.toordinal()
+    scheduler.schedule(next_midnight(scheduler.clock()), reset_daily_quotas)
+
+def schedule_premium_expiry(user):
+    if user.premium_active and user.premium_until is not None:
+        scheduler.schedule(user.premium_until.timestamp(), expire_premium, user.id, user.premium_until)
+
+def expire_premium(user_id, until):
+    user = user_data.get(user_id)
+    # Преміум могли продовжити або змінити після планування
+    if user is None or not user.premium_active or user.premium_until != until:
+        return
+    with dirty_lock:
+        unsaved = "premium" in dirty_user_fields.get(user_id, ()) or "*" in dirty_user_fields.get(user_id, ())
+    user.set_premium(False)
+    if unsaved or users_collection is None:
+        mark_user_dirty(user_id, "premium")
+    else:
+        # Умовне оновлення: з кількох реплік преміум знімає і сповіщає лише одна
+        try:
+            result = users_collection.update_one(
+                {"_id": user_id, "premium.active": True, "premium.until": until.isoformat()},
+                {"$set": {"premium": user.field_value("premium")}}
+            )
+        except Exception as e:
+            print(f"❌ Помилка завершення преміуму {user_id}: {e}")
+            mark_user_dirty(user_id, "premium")
+        else:
+            if not result.modified_count:
+                return
+    if NOTIFY_PREMIUM_EXPIRY:
+        try:
+            bot.send_message(user_id, "⏰ Ваш преміум закінчився.\n\n💎 Продовжити можна в розділі «Преміум» або у @uagptpredlozhkabot")
+        except Exception:
+            pass
+
+def start_scheduler():
+    if users_collection is not None:
+        try:
+            for doc in users_collection.find({"premium.active": True, "premium.until": {"$ne": None}}, {"premium": 1}):
+                scheduler.schedule(parse_datetime(doc["premium"]["until"]).timestamp(), expire_premium, doc["_id"], parse_datetime(doc["premium"]["until"]))
+        except Exception as e:
+            print(f"❌ Помилка завантаження термінів преміуму: {e}")
+    scheduler.schedule(next_midnight(scheduler.clock()), reset_daily_quotas)
+    if bot_settings_collection is not None and SETTINGS_POLL_INTERVAL > 0:
+        scheduler.schedule(scheduler.clock() + SETTINGS_POLL_INTERVAL, poll_settings)
+    if broadcasts_collection is not None:
+        scheduler.schedule(scheduler.clock(), resume_broadcasts)
+    if PREFETCH_HOUR >= 0:
+        scheduler.schedule(next_prefetch(scheduler.clock()), prefetch_trending)
+    scheduler.start()
+
+def poll_settings():
+    """Підхоплює вмикання/вимикання бота, зроблене на іншій репліці."""
+    global BOT_ENABLED
+    try:
+        settings = bot_settings_collection.find_one({"_id": "main_settings"})
+        with dirty_lock:
+            if settings and not settings_dirty:
+                BOT_ENABLED = settings.get("enabled", True)
+    except Exception as e:
+        print(f"❌ Помилка читання налаштувань: {e}")
+    scheduler.schedule(scheduler.clock() + SETTINGS_POLL_INTERVAL, poll_settings)
+
+def set_bot_enabled(enabled):
+    global BOT_ENABLED
+    BOT_ENABLED = enabled
+    if bot_settings_collection is None:
+        if journal is not None:
+            journal.log({"t": "settings", "set": {"enabled": enabled}})
+        return
+    # Записуємо одразу, щоб інші репліки побачили зміну при наступному опитуванні
+    try:
+        bot_settings_collection.update_one({"_id": "main_settings"}, {"$set": {"enabled": enabled}}, upsert=True)
+    except Exception as e:
+        print(f"❌ Помилка збереження налаштувань: {e}")
+        mark_settings_dirty()
+
+# Відстеження змінених записів: зберігаємо лише те, що змінилось
+dirty_lock = threading.RLock()
+dirty_user_fields = {}
+pending_user_incs = {}
+pending_daily_counts = collections.Counter()
+settings_dirty = False
+save_timer = None
+
+def schedule_save():
+    global save_timer
+    with dirty_lock:
+        if save_timer is None:
+            save_timer = threading.Timer(SAVE_DEBOUNCE, debounced_save)
+            save_timer.daemon = True
+            save_timer.start()
+
+def debounced_save():
+    global save_timer
+    with dirty_lock:
+        save_timer = None
+    save_data()
+
+def mark_user_dirty(user_id, *fields):
+    with dirty_lock:
+        dirty_user_fields.setdefault(user_id, set()).update(fields or ("*",))
+    schedule_save()
+
+def inc_user_field(user_id, field, amount=1):
+    # Запис беремо до dirty_lock: репозиторій захоплює свій замок раніше за dirty_lock
+    user = user_data[user_id]
+    with dirty_lock:
+        setattr(user, field, getattr(user, field) + amount)
+        incs = pending_user_incs.setdefault(user_id, {})
+        incs[field] = incs.get(field, 0) + amount
+    schedule_save()
+
+def count_daily(field, amount=1):
+    with dirty_lock:
+        pending_daily_counts[(get_ukraine_time().date().isoformat(), field)] += amount
+    schedule_save()
+
+def mark_settings_dirty():
+    global settings_dirty
+    with dirty_lock:
+        settings_dirty = True
+    schedule_save()
+
+def take_user_changes(user_id):
+    with dirty_lock:
+        return dirty_user_fields.pop(user_id, set()), pending_user_incs.pop(user_id, {})
+
+def forget_user_changes(user_id):
+    take_user_changes(user_id)
+
+def restore_user_changes(user_id, fields, incs):
+    with dirty_lock:
+        if fields:
+            dirty_user_fields.setdefault(user_id, set()).update(fields)
+        pending = pending_user_incs.setdefault(user_id, {}) if incs else {}
+        for field, amount in incs.items():
+            pending[field] = pending.get(field, 0) + amount
+
+def build_user_update(user, fields, incs):
+    user_id = user.id
+    if "*" in fields:
+        to_set = user.to_doc()
+        del to_set["_id"]
+        return pymongo.UpdateOne({"_id": user_id}, {"$set": to_set}, upsert=True)
+    update = {}
+    to_set = {f: user.field_value(f) for f in fields}
+    if "username" in to_set:
+        to_set["username_lc"] = username_lc(user.username)
+    if to_set:
+        update["$set"] = to_set
+    # Поле, яке перезаписується через $set, вже містить актуальне значення лічильника
+    to_inc = {f: n for f, n in incs.items() if f not in to_set}
+    if to_inc:
+        update["$inc"] = to_inc
+    if not update:
+        return None
+    return pymongo.UpdateOne({"_id": user_id}, update, upsert=True)
+
+def save_to_journal(user_fields, user_incs, save_settings):
+    """Та сама пачка змін, що й для MongoDB, але абсолютними значеннями в локальний журнал."""
+    records = []
+    for user_id in set(user_fields) | set(user_incs):
+        user = user_data.peek(user_id)
+        if user is None:
+            continue
+        fields = user_fields.get(user_id, set()) | set(user_incs.get(user_id, ()))
+        if "*" in fields:
+            fields = UserRecord.FIELDS
+        records.append({"t": "user", "id": user_id, "set": {field: user.field_value(field) for field in fields}})
+    if save_settings:
+        records.append({"t": "settings", "set": {"enabled": BOT_ENABLED}})
+    journal.append(records)
+    with span("persistence"):
+        size = journal.commit()
+    if size > journal.compact_bytes:
+        journal.compact(journal_state)
+        print(f"✅ Журнал стиснуто у знімок о {get_ukraine_time().strftime('%H:%M:%S')}")
+
 def save_data():
+    global settings_dirty
+    if users_collection is None and journal is None:
+        print("❌ MongoDB не підключено, пропускаємо збереження")
+        return
+    trending.flush()
+    evicted = user_data.take_evicted()
+    with dirty_lock:
+        user_fields = dict(dirty_user_fields)
+        user_incs = dict(pending_user_incs)
+        daily_counts = dict(pending_daily_counts)
+        save_settings = settings_dirty
+        dirty_user_fields.clear()
+        pending_user_incs.clear()
+        pending_daily_counts.clear()
+        settings_dirty = False
+    # Записи, витіснені з кешу, зберігаються разом з рештою змін
+    records = {}
+    for user_id, (user, fields, incs) in evicted.items():
+        records[user_id] = user
+        user_fields.setdefault(user_id, set()).update(fields)
+        merged = dict(user_incs.get(user_id, {}))
+        for field, amount in incs.items():
+            merged[field] = merged.get(field, 0) + amount
+        if merged:
+            user_incs[user_id] = merged
+    if not (user_fields or user_incs or daily_counts or save_settings):
+        return
+    if users_collection is None:
+        try:
+            save_to_journal(user_fields, user_incs, save_settings)
+        except Exception as e:
+            print(f"❌ Помилка запису журналу: {e}")
+            with dirty_lock:
+                for user_id, fields in user_fields.items():
+                    dirty_user_fields.setdefault(user_id, set()).update(fields)
+                for user_id, incs in user_incs.items():
+                    dirty_user_fields.setdefault(user_id, set()).update(incs)
+                settings_dirty = settings_dirty or save_settings
+        return
     try:
-        if users_collection is None:
-            print("❌ MongoDB не підключено, пропускаємо збереження")
-            return
-        for user_id, user_data_item in user_data.items():
-            user_to_save = user_data_item.copy()
-            if 'reset' in user_to_save and isinstance(user_to_save['reset'], datetime.date):
-                user_to_save['reset'] = user_to_save['reset'].isoformat()
-            if 'premium' in user_to_save and 'until' in user_to_save['premium'] and user_to_save['premium']['until'] and isinstance(user_to_save['premium']['until'], datetime.datetime):
-                user_to_save['premium']['until'] = user_to_save['premium']['until'].isoformat()
-            users_collection.update_one({"_id": user_id}, {"$set": user_to_save}, upsert=True)
-        
-        promo_collection.update_one({"_id": "active_promos"}, {"$set": {"codes": promo_codes}}, upsert=True)
-        bot_settings_collection.update_one({"_id": "main_settings"}, {"$set": {"enabled": BOT_ENABLED}}, upsert=True)
-        print(f"✅ Дані збережено в MongoDB о {get_ukraine_time().strftime('%H:%M:%S')}")
+        ops, op_user_ids = [], []
+        for user_id in set(user_fields) | set(user_incs):
+            user = records.get(user_id) or user_data.peek(user_id)
+            if user is None:
+                continue
+            op = build_user_update(user, user_fields.get(user_id, set()), user_incs.get(user_id, {}))
+            if op is not None:
+                ops.append(op)
+                op_user_ids.append(user_id)
+        if ops:
+            with span("persistence"):
+                try:
+                    users_collection.bulk_write(ops, ordered=False)
+                except pymongo.errors.BulkWriteError as e:
+                    # Невпорядкована пачка записується частково — повертаємо лише операції з помилками, інакше $inc застосується двічі
+                    failed = {op_user_ids[error["index"]] for error in e.details.get("writeErrors", [])}
+                    user_fields = {user_id: fields for user_id, fields in user_fields.items() if user_id in failed}
+                    user_incs = {user_id: incs for user_id, incs in user_incs.items() if user_id in failed}
+                    raise
+            user_fields, user_incs = {}, {}
+
+        if daily_counts:
+            by_day = {}
+            for (day, field), amount in daily_counts.items():
+                by_day.setdefault(day, {})[field] = amount
+            daily_stats_collection.bulk_write([pymongo.UpdateOne({"_id": day}, {"$inc": incs}, upsert=True) for day, incs in by_day.items()], ordered=False)
+            daily_counts = {}
+
+        if save_settings:
+            bot_settings_collection.update_one({"_id": "main_settings"}, {"$set": {"enabled": BOT_ENABLED}}, upsert=True)
+            save_settings = False
+        print(f"✅ Збережено {len(ops)} змінених користувачів в MongoDB о {get_ukraine_time().strftime('%H:%M:%S')}")
     except Exception as e:
         print(f"❌ Помилка збереження даних: {e}")
+        # Повертаємо незбережені зміни, щоб записати їх наступного разу
+        for user_id, user in records.items():
+            if user_data.peek(user_id) is None and user_id in user_fields:
+                user_data[user_id] = user
+        with dirty_lock:
+            for user_id, fields in user_fields.items():
+                dirty_user_fields.setdefault(user_id, set()).update(fields)
+            for user_id, incs in user_incs.items():
+                pending = pending_user_incs.setdefault(user_id, {})
+                for field, amount in incs.items():
+                    pending[field] = pending.get(field, 0) + amount
+            pending_daily_counts.update(daily_counts)
+            settings_dirty = settings_dirty or save_settings
+        schedule_save()
 
 def auto_save():
     save_data()
-    threading.Timer(AUTOSAVE_INTERVAL, auto_save).start()
+    start_autosave()
+
+def start_autosave():
+    # Таймер-демон не тримає процес після зупинки; дані зберігає exit_handler
+    timer = threading.Timer(AUTOSAVE_INTERVAL, auto_save)
+    timer.daemon = True
+    timer.start()
 
 def exit_handler():
     print("\n🛑 Завершення роботи... Зберігаємо дані.")
+    with dirty_lock:
+        if save_timer is not None:
+            save_timer.cancel()
     save_data()
 
 signal.signal(signal.SIGINT, lambda s, f: exit_handler())
@@ -191,111 +1482,657 @@ def format_time(seconds):
     else:
         return f"{seconds//31536000} років"
 
+def site_host(url):
+    host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+def matches_domain(host, domain):
+    return host == domain or host.endswith("." + domain)
+
 def is_russian_site(url):
-    russian_domains = ['.ru', '.рф', 'tinkoff', 'yandex', 'mail.ru', 'rambler', 'kinopoisk']
-    return any(domain in url for domain in russian_domains)
-
-def google_search(query, user_id=None):
-    is_premium = False
-    if user_id and user_id in user_data:
-        user = user_data[user_id]
-        is_premium = user.get('premium', {}).get('active', False) or user_id == ADMIN_ID
-    
-    sites_to_use = BASE_MOVIE_SITES
-    
+    host = site_host(url)
+    return host.endswith(RUSSIAN_TLDS) or any(label in RUSSIAN_DOMAIN_LABELS for label in host.split("."))
+
+def domain_rank(host):
+    for domain, rank in SEARCH_DOMAIN_PRIORITY.items():
+        if matches_domain(host, domain):
+            return rank
+    return DEFAULT_DOMAIN_RANK
+
+def canonical_url(url):
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.urlencode(sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query) if not k.startswith("utm_")))
+    return site_host(url) + parts.path.rstrip("/") + ("?" + query if query else "")
+
+def merge_search_items(shard_items):
+    """Зливає видачу шардів: лише дозволені сайти, без дублікатів за канонічним URL, за пріоритетом домену."""
+    seen = set()
+    ranked = []
+    for shard_index, items in enumerate(shard_items):
+        for position, item in enumerate(items):
+            link = item.get("link", "")
+            host = site_host(link)
+            if is_russian_site(link) or not any(matches_domain(host, site) for site in BASE_MOVIE_SITES):
+                continue
+            key = canonical_url(link)
+            if key in seen:
+                continue
+            seen.add(key)
+            ranked.append(((domain_rank(host), shard_index, position), item))
+    ranked.sort(key=lambda entry: entry[0])
+    return [item for _, item in ranked]
+
+def collect_shard_results(outcomes):
+    """outcomes: ("ok", data) / ("error", виняток) / ("timeout", None) для кожного шарду.
+    Повертає (видача по шардах, чи всі шарди відповіли, перша помилка якщо жоден не відповів)."""
+    shard_items = []
+    complete = True
+    answered = 0
+    first_error = None
+    for status, value in outcomes:
+        if status == "ok" and "error" not in value:
+            shard_items.append(value.get("items", []))
+            answered += 1
+            continue
+        complete = False
+        shard_items.append([])
+        if status == "timeout":
+            search_stats["shard_timeouts"] += 1
+        elif status == "error":
+            search_stats["shard_errors"] += 1
+            first_error = first_error or value
+        else:
+            # API відповіло помилкою (квота тощо) — як і раніше, вважаємо, що нічого не знайдено
+            answered += 1
+    return shard_items, complete, (first_error if not answered else None)
+
+def build_search_request(query, is_premium, classification=None):
+    if classification is None:
+        classification = keyword_classifier.classify(query)
     # Покращена логіка пошуку для українського контенту
     enhanced_query = query
     
     # Додаємо ключові слова для українських серіалів/фільмів
-    if any(word in query.lower() for word in ["українськ", "украинск", "ukrainian"]):
+    if classification.ukrainian:
         enhanced_query = f"{query} україна ukraine"
     
-    # Жанрові ключові слова
-    genre_keywords = {
-        "катастроф": "disaster catastrophe", "жахів": "horror scary", "комеді": "comedy funny",
-        "фантастик": "sci-fi fantasy", "бойовик": "action adventure", "драм": "drama emotional",
-        "мелодрам": "romance romantic", "трилер": "thriller suspense", "детектив": "detective mystery",
-        "аніме": "anime japanese", "історичн": "historical history", "біограф": "biography biographical"
-    }
-    
-    for ukr_keyword, eng_keyword in genre_keywords.items():
-        if ukr_keyword in query.lower():
-            enhanced_query = f"{query} {eng_keyword}"
-            break
+    if classification.genre:
+        enhanced_query = f"{query} {classification.genre}"
     
-    sites_query = " OR ".join([f"site:{site}" for site in sites_to_use])
-    final_query = f"{enhanced_query} ({sites_query})"
     num_results = 8 if is_premium else 5
+    shards = MOVIE_SITE_SHARDS if SEARCH_FANOUT else [BASE_MOVIE_SITES]
+    # Параметри кодує HTTP-клієнт, тож запит більше не склеюється в URL вручну
+    shard_params = [
+        {"q": f"{enhanced_query} ({' OR '.join(f'site:{site}' for site in shard)})", "key": GOOGLE_API_KEY, "cx": SEARCH_ENGINE_ID, "num": str(num_results)}
+        for shard in shards
+    ]
     
-    url = f"https://www.googleapis.com/customsearch/v1?q={final_query}&key={GOOGLE_API_KEY}&cx={SEARCH_ENGINE_ID}&num={num_results}"
+    normalized_query = " ".join(enhanced_query.lower().split())
+    cache_key = hashlib.sha1(f"{normalized_query}|{'premium' if is_premium else 'free'}".encode()).hexdigest()
+    return shard_params, cache_key
+
+def format_search_results(items, is_premium):
+    results = []
+    max_results = 6 if is_premium else 4
+    for item in items[:max_results]:
+        if is_premium:
+            snippet = item.get('snippet', '')
+            if snippet:
+                snippet = snippet[:200] + "..." if len(snippet) > 200 else snippet
+                results.append(f"🎬 {item['title']}\n📝 {snippet}\n🔗 {item['link']}")
+            else:
+                results.append(f"🎬 {item['title']}\n🔗 {item['link']}")
+        else:
+            results.append(f"🎬 {item['title']}\n🔗 {item['link']}")
     
-    try:
-        r = requests.get(url, timeout=15)
-        data = r.json()
-        results = []
-        
-        if "items" in data:
-            for item in data["items"]:
-                if is_russian_site(item.get('link', '')):
+    if results:
+        return "\n\n".join(results)
+    return "🔍 Нічого не знайдено на кіно-сайтах 😔"
+
+def search_shard(params, deadline):
+    # future.cancel() не зупиняє запит, що вже виконується, тож сам запит обмежуємо залишком дедлайну й без повторів
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("дедлайн пошуку вичерпано")
+    return search_client.request("GET", SEARCH_URL, params=params, timeout=(min(UPSTREAM_CONNECT_TIMEOUT, remaining), remaining), max_retries=0).json()
+
+def google_search(query, user_id=None, is_premium=None, classification=None, cache_ttl=None):
+    if is_premium is None:
+        is_premium = is_premium_user(user_id)
+    shard_params, cache_key = build_search_request(query, is_premium, classification)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        prefetcher.search_hit(cache_key)
+        return cached
+    
+    # Усі шарди мають спільний дедлайн: повільний шард не затримує відповідь
+    deadline = time.monotonic() + SEARCH_DEADLINE
+    futures = [search_pool.submit(search_shard, params, deadline) for params in shard_params]
+    done, pending = concurrent.futures.wait(futures, timeout=SEARCH_DEADLINE)
+    for future in pending:
+        future.cancel()
+    outcomes = []
+    for future in futures:
+        if future not in done:
+            outcomes.append(("timeout", None))
+        elif future.exception() is not None:
+            outcomes.append(("error", future.exception()))
+        else:
+            outcomes.append(("ok", future.result()))
+    shard_items, complete, error = collect_shard_results(outcomes)
+    if error is not None:
+        print(f"❌ Помилка пошуку: {error}")
+        return f"❌ Помилка пошуку: {error}"
+    found = format_search_results(merge_search_items(shard_items), is_premium)
+    if complete:
+        search_cache.set(cache_key, found, cache_ttl)
+    return found
+
+CYRILLIC_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "ґ": "g", "д": "d", "е": "e", "є": "e", "ё": "e", "э": "e",
+    "ж": "zh", "з": "z", "и": "i", "і": "i", "ї": "i", "ы": "y", "й": "i", "к": "k", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts",
+    "ч": "ch", "ш": "sh", "щ": "shch", "ю": "iu", "я": "ia", "ь": "", "ъ": "", "'": "", "’": "", "ʼ": ""
+})
+# Слова запиту, що не належать до назви
+MOVIE_QUERY_STOPWORDS = {key.translate(CYRILLIC_TRANSLIT) for key in movie_keywords + [
+    "про", "розкажи", "розкажіть", "що", "за", "знайди", "покажи", "інформація", "інфо", "рік", "року", "році",
+    "який", "яка", "яке", "хочу", "дізнатись", "дізнатися", "tell", "me", "about", "info", "film", "the"
+]}
+MOVIE_CARD_TITLE = re.compile(r"🎬\W*Назва\W*(.+)")
+MOVIE_CARD_YEAR = re.compile(r"📅[^\n\d]*((?:19|20)\d\d)")
+
+def movie_key(text):
+    """Нормалізує назву в латиницю без службових слів; повертає (ключ, рік або None)."""
+    words = re.sub(r"[^\w]+", " ", text.lower().translate(CYRILLIC_TRANSLIT)).split()
+    years = [int(word) for word in words if re.fullmatch(r"(?:19|20)\d\d", word)]
+    words = [word for word in words if word not in MOVIE_QUERY_STOPWORDS and not re.fullmatch(r"(?:19|20)\d\d", word)]
+    return " ".join(words), (years[0] if years else None)
+
+def parse_movie_card(text):
+    """Витягує назву, аліаси та рік зі згенерованої картки; None, якщо це не рівно одна картка."""
+    titles = MOVIE_CARD_TITLE.findall(text)
+    if len(titles) != 1 or text.count("🎬") != 1:
+        return None
+    title = titles[0].strip(" *_«»\"")
+    year = MOVIE_CARD_YEAR.search(text)
+    # "Дюна (Dune)", "Дюна / Dune": кожна частина — окремий аліас (українська, англійська, оригінальна)
+    aliases = {movie_key(part)[0] for part in [title] + re.split(r"[()/|]", title)}
+    aliases.discard("")
+    if not aliases:
+        return None
+    return {"title": title, "year": int(year.group(1)) if year else None, "aliases": sorted(aliases)}
+
+ROMAN_NUMERALS = {"ii", "iii", "iv", "vi", "vii", "viii", "ix", "x"}
+
+def title_numbers(key):
+    return {word for word in key.split() if word.isdigit() or word in ROMAN_NUMERALS}
+
+def alias_score(key, alias):
+    """Схожість запиту й аліаса; номери частин ("аватар 2", "rocky iii") і короткі назви мають збігатися точно, як і рік."""
+    if title_numbers(key) != title_numbers(alias):
+        return 0
+    if min(len(key), len(alias)) < MOVIE_INDEX_EXACT_LEN:
+        return 1.0 if key == alias else 0
+    return difflib.SequenceMatcher(None, key, alias).ratio()
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class MovieIndex:
+    """Картки фільмів за нормалізованою назвою; нечіткий пошук через інвертований індекс триграм аліасів."""
+
+    def __init__(self, collection, size, min_score):
+        self.collection = collection
+        self.size = size
+        self.min_score = min_score
+        self.cards = collections.OrderedDict()
+        self.postings = collections.defaultdict(set)
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    def load(self):
+        for doc in self.collection.find().sort("updated", -1).limit(self.size):
+            self.put(doc)
+
+    def put(self, doc):
+        with self.lock:
+            self.drop(doc["_id"])
+            self.cards[doc["_id"]] = doc
+            for alias in doc["aliases"]:
+                for gram in trigrams(alias):
+                    self.postings[gram].add(doc["_id"])
+            while len(self.cards) > self.size:
+                self.drop(next(iter(self.cards)))
+
+    def drop(self, card_id):
+        doc = self.cards.pop(card_id, None)
+        if doc is None:
+            return
+        for alias in doc["aliases"]:
+            for gram in trigrams(alias):
+                self.postings[gram].discard(card_id)
+                if not self.postings[gram]:
+                    del self.postings[gram]
+
+    def fresh(self, doc, tier):
+        ttl = MOVIE_INDEX_UPCOMING_TTL if doc["year"] is None or doc["year"] > datetime.datetime.now().year else MOVIE_INDEX_TTL
+        return time.time() - doc["cards"][tier]["updated"] < ttl
+
+    def lookup(self, question, is_premium, count=True):
+        """Повертає готову картку, якщо назва впевнено збігається і картка ще свіжа; інакше None.
+        count=False — перевірка без лічильників (для прогріву)."""
+        key, year = movie_key(question)
+        if not key:
+            return None
+        tier = "premium" if is_premium else "free"
+        grams = trigrams(key)
+        with self.lock:
+            shared = collections.Counter()
+            for gram in grams:
+                for card_id in self.postings.get(gram, ()):
+                    shared[card_id] += 1
+            best, best_score = None, 0
+            for card_id, _ in shared.most_common(20):
+                doc = self.cards[card_id]
+                if year is not None and doc["year"] is not None and doc["year"] != year:
                     continue
-                if any(site in item['link'] for site in sites_to_use):
-                    if is_premium:
-                        snippet = item.get('snippet', '')
-                        if snippet:
-                            snippet = snippet[:200] + "..." if len(snippet) > 200 else snippet
-                            results.append(f"🎬 {item['title']}\n📝 {snippet}\n🔗 {item['link']}")
-                        else:
-                            results.append(f"🎬 {item['title']}\n🔗 {item['link']}")
-                    else:
-                        results.append(f"🎬 {item['title']}\n🔗 {item['link']}")
-        
-        if results:
-            def sort_key(result):
-                if "kinoukr.com" in result: return 0
-                if "film.ua" in result: return 1
-                if "kino-teatr.ua" in result: return 2
-                if "imdb.com" in result: return 3
-                if "themoviedb.org" in result: return 4
-                return 5
-            results.sort(key=sort_key)
-            max_results = 6 if is_premium else 4
-            results = results[:max_results]
-            return "\n\n".join(results)
+                score = max(alias_score(key, alias) for alias in doc["aliases"])
+                if score > best_score:
+                    best, best_score = doc, score
+        if best is None or best_score < self.min_score or tier not in best["cards"]:
+            result = "miss"
+        elif not self.fresh(best, tier):
+            result = "stale"
         else:
-            return "🔍 Нічого не знайдено на кіно-сайтах 😔"
-    except Exception as e:
-        print(f"❌ Помилка пошуку: {e}")
-        return f"❌ Помилка пошуку: {e}"
+            result = "hit"
+        if count:
+            self.stats[result] += 1
+            if result == "hit" and best["cards"][tier].get("prefetched"):
+                prefetcher.stats["card_hits"] += 1
+        return best["cards"][tier]["text"] if result == "hit" else None
+
+    def record(self, question, is_premium, response, prefetched=False):
+        parsed = parse_movie_card(response)
+        if parsed is None:
+            return
+        # Запит користувача теж стає аліасом, але лише якщо він і так схожий на назву
+        key, _ = movie_key(question)
+        if key and max(alias_score(key, alias) for alias in parsed["aliases"]) >= self.min_score:
+            parsed["aliases"] = sorted(set(parsed["aliases"]) | {key})
+        card_id = f"{movie_key(parsed['title'])[0] or parsed['aliases'][0]}|{parsed['year']}"
+        tier = "premium" if is_premium else "free"
+        now = time.time()
+        with self.lock:
+            previous = self.cards.get(card_id)
+        doc = {
+            "_id": card_id, "title": parsed["title"], "year": parsed["year"],
+            "aliases": sorted(set(parsed["aliases"]) | set(previous["aliases"] if previous else ())),
+            "cards": dict(previous["cards"] if previous else {}, **{tier: {"text": response, "updated": now, "prefetched": prefetched}}),
+            "updated": now,
+        }
+        self.put(doc)
+        self.stats["stored"] += 1
+        if self.collection is not None:
+            # Запис у базу — у потоці планувальника, щоб не блокувати обробку (і цикл подій в async-режимі)
+            scheduler.schedule(now, self.persist, doc)
+
+    def persist(self, doc):
+        self.collection.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+
+    def status(self):
+        return f"🗂 Індекс фільмів: {len(self.cards)} карток, влучань {self.stats['hit']}, промахів {self.stats['miss']}, застарілих {self.stats['stale']}"
+
+movie_index = MovieIndex(movie_cards_collection, MOVIE_INDEX_SIZE, MOVIE_INDEX_MIN_SCORE)
+
+class TrendingQueries:
+    """Денні лічильники нормалізованих назв із запитів про фільми; в MongoDB — по документу на (день, назву)."""
+
+    def __init__(self, collection, days):
+        self.collection = collection
+        self.days = days
+        # (день, ключ) -> [кількість, приклад запиту]; приклад живе лише до запису в базу
+        self.pending = {}
+        self.local = collections.defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def observe(self, text):
+        key, _ = movie_key(text)
+        if not key:
+            return
+        day = get_ukraine_time().date().isoformat()
+        with self.lock:
+            if self.collection is None:
+                entry = self.local[day].setdefault(key, [0, text])
+            else:
+                entry = self.pending.setdefault((day, key), [0, text])
+            entry[0] += 1
+            entry[1] = text
 
-def ask_gemini(user_id, question, context_messages=None):
-    if context_messages is None:
-        context_messages = []
-    
-    # Фільтруємо контекст - лише останні повідомлення
-    recent_context = context_messages[-MAX_HISTORY:] if len(context_messages) > MAX_HISTORY else context_messages
-    
-    context_text = "\n".join([f"Попереднє повідомлення: {msg}" for msg in recent_context])
-    
-    question_lower = question.lower()
-    is_movie_query = any(word in question_lower for word in movie_keywords) and not any(word in question_lower for word in code_keywords)
-    is_code_query = any(word in question_lower for word in code_keywords) and not any(word in question_lower for word in movie_keywords)
-    
-    search_results = ""
+    def flush(self):
+        """Записує накопичені лічильники одним bulk_write; викликається разом зі збереженням даних."""
+        if self.collection is None:
+            return
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            self.collection.bulk_write([
+                pymongo.UpdateOne(
+                    {"_id": f"{day}|{key}"},
+                    {"$inc": {"count": count}, "$set": {"day": day, "key": key, "text": text, "created_at": now}},
+                    upsert=True
+                ) for (day, key), (count, text) in pending.items()
+            ], ordered=False)
+        except Exception as e:
+            print(f"❌ Помилка збереження популярних запитів: {e}")
+            with self.lock:
+                for pending_key, (count, text) in pending.items():
+                    entry = self.pending.setdefault(pending_key, [0, text])
+                    entry[0] += count
+
+    def top(self, limit):
+        """Повертає [(ключ, приклад запиту, кількість)] за останні days днів."""
+        since = (get_ukraine_time().date() - datetime.timedelta(days=self.days - 1)).isoformat()
+        if self.collection is None:
+            with self.lock:
+                totals, samples = collections.Counter(), {}
+                for day in [day for day in self.local if day < since]:
+                    del self.local[day]
+                for counts in self.local.values():
+                    for key, (count, text) in counts.items():
+                        totals[key] += count
+                        samples[key] = text
+                return [(key, samples[key], count) for key, count in totals.most_common(limit)]
+        pipeline = [
+            {"$match": {"day": {"$gte": since}}},
+            {"$group": {"_id": "$key", "count": {"$sum": "$count"}, "text": {"$last": "$text"}}},
+            {"$sort": {"count": -1}},
+            {"$limit": limit},
+        ]
+        return [(doc["_id"], doc["text"], doc["count"]) for doc in self.collection.aggregate(pipeline)]
+
+trending = TrendingQueries(movie_queries_collection, TRENDING_DAYS)
+
+class Prefetcher:
+    """Поза піком прогріває кеш пошуку та індекс карток для найпопулярніших назв у межах бюджету викликів API."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.search_keys = set()
+        self.stats = collections.Counter()
+        self.last_run = None
+        self.spent = 0
+        self.warmed = 0
+
+    def search_hit(self, cache_key):
+        if cache_key in self.search_keys:
+            self.stats["search_hits"] += 1
+
+    def claim(self, day):
+        """Лише одна репліка прогріває кеш за добу."""
+        if bot_settings_collection is None:
+            return True
+        try:
+            result = bot_settings_collection.update_one({"_id": "prefetch", "day": {"$ne": day}}, {"$set": {"day": day}}, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return bool(result.modified_count or result.upserted_id)
+
+    def warm(self, text, is_premium):
+        """Прогріває одну назву; повертає кількість витрачених викликів API або None, якщо бюджету не вистачає."""
+        classification = keyword_classifier.classify(text)
+        shard_params, cache_key = build_search_request(text, is_premium, classification)
+        cost = len(shard_params) + 1
+        if self.spent + cost > self.budget:
+            return None
+        prepared = PreparedRequest(user_id=0, question=text, kind="movie", is_premium=is_premium, classification=classification)
+        prepared.search_results = google_search(text, is_premium=is_premium, classification=classification, cache_ttl=PREFETCH_SEARCH_TTL)
+        self.search_keys.add(cache_key)
+        finish_request(prepared)
+        # Кеш відповідей живе пів години й до піку не доживе — прогріваємо лише індекс карток
+        prepared.cache_key = None
+        prepared.prefetched = True
+        response = ask_gemini(0, text, prepared)
+        if not response.startswith("❌"):
+            self.warmed += 1
+        return cost
+
+    def run(self):
+        self.last_run = get_ukraine_time().strftime("%d.%m %H:%M")
+        self.spent = 0
+        self.warmed = 0
+        self.search_keys = set()
+        try:
+            candidates = [(text, tier == "premium") for _, text, _ in trending.top(PREFETCH_TOP_N) for tier in PREFETCH_TIERS]
+            for text, is_premium in candidates:
+                if movie_index.lookup(text, is_premium, count=False) is not None:
+                    self.stats["already_warm"] += 1
+                    continue
+                cost = self.warm(text, is_premium)
+                if cost is None:
+                    self.stats["budget_stops"] += 1
+                    break
+                self.spent += cost
+        except Exception as e:
+            print(f"❌ Помилка прогріву: {e}")
+        print(f"✅ Прогрів завершено: {self.warmed} назв, {self.spent} викликів API")
+
+    def status(self):
+        if self.last_run is None:
+            return "🔥 Прогрів: ще не запускався"
+        return (f"🔥 Прогрів {self.last_run}: прогріто {self.warmed} назв, витрачено {self.spent}/{self.budget} викликів API\n"
+                f"   Влучання в прогріте: картки {self.stats['card_hits']}, пошук {self.stats['search_hits']}")
+
+prefetcher = Prefetcher(PREFETCH_BUDGET)
+
+def next_prefetch(now_ts):
+    now = datetime.datetime.fromtimestamp(now_ts, UKRAINE_TZ)
+    run_at = UKRAINE_TZ.localize(datetime.datetime.combine(now.date(), datetime.time(PREFETCH_HOUR)))
+    if run_at.timestamp() <= now_ts:
+        run_at = UKRAINE_TZ.localize(datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(PREFETCH_HOUR)))
+    return run_at.timestamp()
+
+def prefetch_trending():
+    scheduler.schedule(next_prefetch(scheduler.clock()), prefetch_trending)
+    day = get_ukraine_time().date().isoformat()
+    if not MOVIE_INDEX or not prefetcher.claim(day):
+        return
+    trending.flush()
+    # Прогрів триває хвилини — не тримаємо потік планувальника
+    threading.Thread(target=prefetcher.run, daemon=True).start()
+
+@dataclasses.dataclass
+class PreparedRequest:
+    """Результат класифікації, пошуку та побудови промпту для одного повідомлення."""
+    user_id: int
+    question: str
+    kind: str
+    is_premium: bool
+    classification: Classification = None
+    search_results: str = ""
+    prompt: str = ""
+    context: list = dataclasses.field(default_factory=list)
+    max_output_tokens: int = 1024
+    cache_key: str = None
+    indexed_card: str = None
+    prefetched: bool = False
+
+def is_premium_user(user_id):
+    if user_id == ADMIN_ID:
+        return True
+    user = user_data.get(user_id)
+    return bool(user and user.premium_active)
+
+def prepare_request(user_id, question, is_premium=None):
+    if is_premium is None:
+        is_premium = is_premium_user(user_id)
+    with span("classification"):
+        classification = keyword_classifier.classify(question)
+    request = PreparedRequest(user_id=user_id, question=question, kind=classification.kind, is_premium=is_premium, classification=classification)
+    if request.kind == "movie":
+        with span("search"):
+            request.indexed_card = movie_index.lookup(question, is_premium) if MOVIE_INDEX else None
+            if request.indexed_card is None:
+                request.search_results = google_search(question, user_id, is_premium, classification)
+    return finish_request(request)
+
+def finish_request(request):
+    user = user_data.get(request.user_id)
+    if user is not None:
+        with span("context"):
+            if USER_CACHE_TTL:
+                # Попередню репліку могла обробити інша репліка вебхука
+                user_data.refresh(user, UserRecord.CONVERSATION_FIELDS)
+            request.context = build_context(user, request.is_premium)
+    request.prompt = build_prompt(request)
+    request.max_output_tokens = 2048 if request.kind == "movie" and request.is_premium else 1024
+    prompt_tokens.observe(estimate_tokens(request.prompt) + sum(estimate_tokens(turn["parts"][0]["text"]) for turn in request.context))
+    if request.kind in RESPONSE_CACHE_KINDS:
+        window = "\n".join(" ".join(turn["parts"][0]["text"].lower().split()) for turn in request.context)
+        question = " ".join(request.question.lower().split())
+        request.cache_key = hashlib.sha1(f"{request.kind}|{question}|{window}|{request.max_output_tokens}".encode()).hexdigest()
+    return request
+
+def cached_response(prepared):
+    if prepared.indexed_card is not None:
+        return prepared.indexed_card
+    if prepared.cache_key is None:
+        return None
+    response = response_cache.get(prepared.cache_key)
+    if response is not None:
+        response_cache_hits[prepared.kind] += 1
+    return response
+
+def store_response(prepared, response):
+    if prepared.cache_key is not None and not response.startswith("❌"):
+        response_cache.set(prepared.cache_key, response)
+    if MOVIE_INDEX and prepared.kind == "movie" and not response.startswith("❌"):
+        movie_index.record(prepared.question, prepared.is_premium, response, prepared.prefetched)
+
+def estimate_tokens(text):
+    # Грубо: ~3 символи на токен для змішаного українського й англійського тексту
+    return len(text) // 3 + 1
+
+def context_budget(is_premium):
+    return CONTEXT_TOKENS_PREMIUM if is_premium else CONTEXT_TOKENS_FREE
+
+def append_turn(contents, role, text):
+    # Gemini очікує, що ролі чергуються, тож сусідні репліки однієї ролі зливаємо
+    if contents and contents[-1]["role"] == role:
+        contents[-1]["parts"][0]["text"] += "\n\n" + text
+    else:
+        contents.append({"role": role, "parts": [{"text": text}]})
+
+def build_context(user, is_premium):
+    """Попередні репліки у форматі contents Gemini: підсумок старішої розмови й найновіші репліки в межах бюджету токенів."""
+    budget = context_budget(is_premium)
+    used = estimate_tokens(user.summary) if user.summary else 0
+    turns, skipped = [], 0
+    for turn in reversed(user.history):
+        cost = estimate_tokens(turn["text"])
+        # Останню пару реплік передаємо завжди, навіть якщо вона сама більша за бюджет
+        if skipped or (used + cost > budget and len(turns) >= 2):
+            skipped += cost
+            continue
+        turns.append(turn)
+        used += cost
+    contents = []
+    if user.summary:
+        append_turn(contents, "user", f"Підсумок нашої попередньої розмови: {user.summary}")
+        append_turn(contents, "model", "Зрозуміло, враховую це.")
+    for turn in reversed(turns):
+        append_turn(contents, turn["role"], turn["text"])
+    if contents and contents[0]["role"] == "model":
+        contents.pop(0)
+    context_stats["context_tokens"] += used
+    context_stats["skipped_tokens"] += skipped
+    return contents
+
+def remember_exchange(prepared, response):
+    """Зберігає обидві репліки; коли історія перевищує бюджет, найстаріші стискаються в підсумок."""
+    if response.startswith("❌"):
+        return
+    user = user_data.get(prepared.user_id)
+    if user is None:
+        return
+    budget = context_budget(prepared.is_premium)
+    overflow = []
+    for role, text in (("user", prepared.question), ("model", response)):
+        if len(user.history) == HISTORY_LIMIT:
+            overflow.append(user.history.popleft())
+        user.history.append({"role": role, "text": text})
+    total = sum(estimate_tokens(turn["text"]) for turn in user.history)
+    if total > budget:
+        # Стискаємо із запасом, щоб не викликати підсумовування на кожному повідомленні;
+        # щойно додану пару не чіпаємо — на неї посилаються уточнення на кшталт "виправ цей код"
+        while len(user.history) > 2 and (total > budget * 3 // 4 or user.history[0]["role"] != "user"):
+            turn = user.history.popleft()
+            total -= estimate_tokens(turn["text"])
+            overflow.append(turn)
+    if overflow:
+        user.summary = summarize_turns(user.summary, overflow)
+    persist_turns(user, list(user.history)[-2:], bool(overflow))
+
+def persist_turns(user, turns, summary_changed):
+    """Дописує репліки атомарним $push зі $slice, тож репліки вебхука не перезаписують історію одна одної."""
+    if users_collection is None:
+        mark_user_dirty(user.id, "history", *(["summary"] if summary_changed else []))
+        return
+    # Обрізаємо до локальної довжини: старіші репліки вже стиснуті в підсумок
+    update = {"$push": {"history": {"$each": turns, "$slice": -len(user.history)}}}
+    if summary_changed:
+        update["$set"] = {"summary": user.summary}
+    try:
+        with span("persistence"):
+            users_collection.update_one({"_id": user.id}, update, upsert=True)
+    except Exception as e:
+        print(f"❌ Помилка збереження історії {user.id}: {e}")
+        mark_user_dirty(user.id, "history", "summary")
+
+def summarize_turns(summary, turns):
+    context_stats["summaries"] += 1
+    context_stats["summarized_tokens"] += sum(estimate_tokens(turn["text"]) for turn in turns)
+    dialog = "\n".join(f"{'Користувач' if turn['role'] == 'user' else 'Бот'}: {turn['text']}" for turn in turns)
+    result = None
+    if SUMMARIZE_WITH_GEMINI and GEMINI_API_KEY:
+        prompt = f"""Онови стислий підсумок розмови користувача з ботом (не більше {SUMMARY_MAX_TOKENS * 2 // 3} слів).
+Збережи факти про користувача, його вподобання, згадані фільми, мови програмування й незакриті питання. Не додавай нічого від себе.
+
+Поточний підсумок:
+{summary or "—"}
+
+Нові репліки:
+{dialog}"""
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
+        data = {"contents": [{"role": "user", "parts": [{"text": prompt}]}], "generationConfig": {"maxOutputTokens": SUMMARY_MAX_TOKENS, "temperature": 0.2}}
+        try:
+            result = parse_gemini_reply(gemini_client.request("POST", url, headers={"Content-Type": "application/json"}, json=data).json())
+        except Exception as e:
+            print(f"❌ Помилка підсумовування розмови: {e}")
+        if result and result.startswith("❌"):
+            result = None
+    if not result:
+        # Запасний варіант без запиту: початки повідомлень користувача
+        notes = [turn["text"][:120].replace("\n", " ") for turn in turns if turn["role"] == "user"]
+        result = " | ".join(filter(None, [summary] + notes))
+    # Лишаємо найновішу частину, щоб підсумок не ріс безмежно
+    result = result.strip()[-SUMMARY_MAX_TOKENS * 3:]
+    context_stats["summary_tokens"] += estimate_tokens(result) - (estimate_tokens(summary) if summary else 0)
+    return result
+
+def build_prompt(request):
+    question = request.question
+    search_results = request.search_results
     current_year = datetime.datetime.now().year
 
-    if is_movie_query:
-        search_results = google_search(question, user_id)
-        is_premium = False
-        if user_id in user_data:
-            user = user_data[user_id]
-            is_premium = user.get('premium', {}).get('active', False) or user_id == ADMIN_ID
-        
-        if is_premium:
+    if request.kind == "movie":
+        if request.is_premium:
             prompt = f"""Ти експерт по фільмах, серіалах та аніме. Відповідай ДЕТАЛЬНО та ПРОФЕСІЙНО.
 
-Контекст розмови:
-{context_text}
-
 Поточний рік: {current_year}
 Запит: {question}
 
@@ -324,9 +2161,6 @@ def ask_gemini(user_id, question, context_messages=None):
         else:
             prompt = f"""Ти експерт по фільмах, серіалах та аніме. Відповідай ТОЧНО та КОНКРЕТНО.
 
-Контекст розмови:
-{context_text}
-
 Поточний рік: {current_year}
 Запит: {question}
 
@@ -346,12 +2180,9 @@ def ask_gemini(user_id, question, context_messages=None):
 📖 Опис сюжету (2-3 речення):
 
 Якщо точно не знаєш - так і скажи, але запропонуй схожі варіанти."""
-    elif is_code_query:
+    elif request.kind == "code":
         prompt = f"""Ти експерт-програміст. Відповідай ЧІТКИМ КОДОМ на запит.
 
-Контекст розмови:
-{context_text}
-
 Запит: {question}
 
 ВИМОГИ:
@@ -363,9 +2194,6 @@ def ask_gemini(user_id, question, context_messages=None):
     else:
         prompt = f"""Ти дружній AI-асистент. Відповідай природньo та зрозуміло.
 
-Контекст розмови:
-{context_text}
-
 Запит: {question}
 
 Вимоги:
@@ -374,31 +2202,88 @@ def ask_gemini(user_id, question, context_messages=None):
 3. Відповідай розгорнуто але не занадто довго
 4. Використовуй емодзі
 5. Будь корисним та інформативним"""
+    return prompt
+
+def ask_gemini(user_id, question, prepared=None):
+    if prepared is None:
+        prepared = prepare_request(user_id, question)
+    cached = cached_response(prepared)
+    if cached is not None:
+        return cached
+
+    url, data = build_gemini_request(prepared)
+    try:
+        response = gemini_client.request("POST", url, headers={"Content-Type": "application/json"}, json=data)
+        reply = parse_gemini_reply(response.json())
+        store_response(prepared, reply)
+        return reply
+    except Exception as e:
+        return f"❌ Помилка: {e}"
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro:generateContent?key={GEMINI_API_KEY}"
-    headers = {"Content-Type": "application/json"}
+def stream_gemini(prepared, on_text):
+    url, data = build_gemini_request(prepared, stream=True)
+    started = time.monotonic()
+    response = gemini_client.request("POST", url, headers={"Content-Type": "application/json"}, json=data, stream=True)
+    text = ""
+    with response:
+        # text/event-stream без charset requests декодує як ISO-8859-1 — декодуємо байти самі, як і в async-режимі
+        for raw_line in response.iter_lines():
+            piece = parse_stream_line(raw_line.decode("utf-8"))
+            if not piece:
+                continue
+            if not text:
+                gemini_ttft.observe(time.monotonic() - started)
+            text += piece
+            on_text(text)
+    return text or "❌ Помилка API. Спробуйте ще раз."
+
+def parse_stream_line(line):
+    if not line or not line.startswith("data:"):
+        return ""
+    try:
+        chunk = json.loads(line[5:])
+        # usageMetadata приходить лише в останньому фрагменті з finishReason
+        if chunk.get("candidates", [{}])[0].get("finishReason"):
+            record_gemini_usage(chunk)
+        parts = chunk["candidates"][0]["content"]["parts"]
+    except (ValueError, KeyError, IndexError):
+        return ""
+    return "".join(part.get("text", "") for part in parts)
+
+def build_gemini_request(prepared, stream=False):
+    method = "streamGenerateContent?alt=sse&" if stream else "generateContent?"
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro:{method}key={GEMINI_API_KEY}"
+    contents = [dict(turn, parts=[dict(turn["parts"][0])]) for turn in prepared.context]
+    append_turn(contents, "user", prepared.prompt)
     data = {
-        "contents": [{"parts": [{"text": prompt}]}],
+        "contents": contents,
         "generationConfig": {
-            "maxOutputTokens": 2048 if is_movie_query and is_premium else 1024,
+            "maxOutputTokens": prepared.max_output_tokens,
             "temperature": 0.7
         }
     }
-    
-    try:
-        response = requests.post(url, headers=headers, json=data, timeout=25)
-        result = response.json()
-        if "candidates" in result:
-            reply = result["candidates"][0]["content"]["parts"][0]["text"]
-            return reply
-        else:
-            return "❌ Помилка API. Спробуйте ще раз."
-    except Exception as e:
-        return f"❌ Помилка: {e}"
+    return url, data
+
+def parse_gemini_reply(result):
+    record_gemini_usage(result)
+    if "candidates" in result:
+        return result["candidates"][0]["content"]["parts"][0]["text"]
+    return "❌ Помилка API. Спробуйте ще раз."
+
+def extract_code(text):
+    blocks = re.findall(r"```[\w+#.-]*\n?(.*?)```", text, re.DOTALL)
+    return "\n\n".join(block.strip("\n") for block in blocks) if blocks else text
+
+def store_snippet(code_text):
+    # Стабільний між перезапусками ідентифікатор (hash() для str залежить від процесу)
+    # Дайджест і є вмістом, тож перезапис того самого коду нічого не змінює — читати перед записом не потрібно
+    digest = hashlib.sha256(code_text.encode()).hexdigest()[:32]
+    snippet_store.set(digest, extract_code(code_text))
+    return digest
 
 def create_copy_button(code_text):
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("📋 Скопіювати код", callback_data=f"copy_{hash(code_text)}"))
+    keyboard.add(InlineKeyboardButton("📋 Скопіювати код", callback_data=f"copy_{store_snippet(code_text)}"))
     return keyboard
 
 def premium_menu_keyboard():
@@ -412,10 +2297,12 @@ def premium_menu_keyboard():
 def admin_keyboard():
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add(KeyboardButton("👥 Список користувачів"))
+    kb.add(KeyboardButton("🔍 Пошук користувача"))
     kb.add(KeyboardButton("🎫 Керування промокодами"))
     kb.add(KeyboardButton("➕ Додати преміум"))
     kb.add(KeyboardButton("⏰ Преміум на час"))
     kb.add(KeyboardButton("🗑️ Видалити користувача"))
+    kb.add(KeyboardButton("📢 Розсилка"))
     kb.add(KeyboardButton("📊 Статистика"))
     kb.add(KeyboardButton("⚙️ Керування ботом"))
     kb.add(KeyboardButton("🔙 Головне меню"))
@@ -440,9 +2327,68 @@ def main_menu():
         kb.add(KeyboardButton("⚙️ Адмін панель"))
     return kb
 
+def update_user_profile(user_id, from_user):
+    user = user_data[user_id]
+    changed = [field for field in ("username", "first_name", "last_name") if getattr(user, field) != getattr(from_user, field)]
+    for field in changed:
+        setattr(user, field, getattr(from_user, field))
+    if changed:
+        mark_user_dirty(user_id, *changed)
+
 def help_text():
     return "🤖 <b>Що може цей бот:</b>\n\n🎬 <b>Пошук фільмів/серіалів/аніме:</b>\n• Знаходження за назвою, роком, країною\n• Пошук за описом сюжету\n• Інформація про рейтинг та жанр\n\n💻 <b>Генерація коду:</b>\n• Створення HTML/CSS/JS кодів\n• Python скрипти та програми\n• Зручне копіювання\n\n💬 <b>Звичайне спілкування:</b>\n• Відповіді на будь-які запитання\n• Допомога з різних тем\n\n💎 <b>Преміум система:</b>\n• Необмежені запити\n• Пріоритетна обробка\n• Розширена база кіносайтів\n• Детальніші описи фільмів\n• Більше результатів пошуку\n\n🐞 Техпідтримка: @uagptpredlozhkabot"
 
+class MessageDispatcher:
+    """Пул воркерів: не більше одного запиту в обробці на чат, обмежена загальна черга."""
+
+    def __init__(self, handler, workers, max_pending):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.ready = queue.Queue()
+        self.chats = {}
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.processed = 0
+        self.rejected = 0
+        self.wait_time = Histogram()
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, message):
+        chat_id = message.chat.id
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            chat_queue = self.chats.get(chat_id)
+            if chat_queue is None:
+                self.chats[chat_id] = collections.deque([(time.monotonic(), message)])
+                self.ready.put(chat_id)
+            else:
+                chat_queue.append((time.monotonic(), message))
+        return True
+
+    def _worker(self):
+        while True:
+            chat_id = self.ready.get()
+            with self.lock:
+                enqueued_at, message = self.chats[chat_id].popleft()
+            self.wait_time.observe(time.monotonic() - enqueued_at)
+            try:
+                self.handler(message)
+            except Exception as e:
+                print(f"❌ Помилка обробки повідомлення: {e}")
+            with self.lock:
+                self.pending -= 1
+                self.processed += 1
+                if self.chats[chat_id]:
+                    self.ready.put(chat_id)
+                else:
+                    del self.chats[chat_id]
+
+dispatcher = None
+
 load_data()
 
 @bot.message_handler(commands=["start"])
@@ -451,18 +2397,9 @@ def start(message):
         return
     user_id = message.from_user.id
     if user_id not in user_data:
-        user_data[user_id] = {
-            "_id": user_id, "used": 0, "premium": {"active": False, "until": None},
-            "reset": get_ukraine_time().date().isoformat(), "history": [],
-            "free_used": False, "last_movie_query": None, "last_code": None,
-            "username": message.from_user.username, "first_name": message.from_user.first_name,
-            "last_name": message.from_user.last_name
-        }
+        create_user(user_id, message.from_user.username, message.from_user.first_name, message.from_user.last_name)
     else:
-        user_data[user_id]["username"] = message.from_user.username
-        user_data[user_id]["first_name"] = message.from_user.first_name
-        user_data[user_id]["last_name"] = message.from_user.last_name
-    save_data()
+        update_user_profile(user_id, message.from_user)
     bot.reply_to(message, "👋 Вітаю! Я твій AI-помічник! Можу:\n• 🎬 Шукати фільми/серіали/аніме\n• 💻 Писати код\n• 💬 Вільно спілкуватись\n\nПросто напиши що потрібно! 😊", reply_markup=main_menu())
 
 @bot.message_handler(commands=["profile"])
@@ -480,51 +2417,29 @@ def profile(message):
         start(message)
         return
     user = user_data[user_id]
-    today = get_ukraine_time().date()
-    
-    if isinstance(user["reset"], str):
-        reset_date = datetime.date.fromisoformat(user["reset"])
-    else:
-        reset_date = user["reset"]
-    
-    if reset_date != today:
-        user["used"] = 0
-        user["reset"] = today.isoformat()
-        save_data()
+    quota.roll_day(user)
     
     premium_status = "❌ Немає"
-    if user["premium"]["active"]:
-        if user["premium"]["until"] is None:
+    if user.premium_active:
+        if user.premium_until is None:
             premium_status = "♾️ Назавжди"
         else:
-            if isinstance(user["premium"]["until"], str):
-                until_date = datetime.datetime.fromisoformat(user["premium"]["until"])
-                if until_date.tzinfo is None:
-                    until_date = UKRAINE_TZ.localize(until_date)
-            else:
-                until_date = user["premium"]["until"]
-            
-            current_time = get_ukraine_time()
-            if until_date > current_time:
-                premium_status = f"✅ До {until_date.astimezone(UKRAINE_TZ).strftime('%d.%m.%Y %H:%M')}"
-            else:
-                user["premium"] = {"active": False, "until": None}
-                save_data()
+            premium_status = f"✅ До {user.premium_until.astimezone(UKRAINE_TZ).strftime('%d.%m.%Y %H:%M')}"
     
-    role = "👑 Адміністратор" if user_id == ADMIN_ID else ("💎 Преміум" if user["premium"]["active"] else "👤 Користувач")
-    username = user.get('username', '')
+    role = "👑 Адміністратор" if user_id == ADMIN_ID else ("💎 Преміум" if user.premium_active else "👤 Користувач")
+    username = user.username
     if not username:
         username = "немає"
     else:
         username = "@" + username
     
-    first_name = user.get('first_name', '')
-    last_name = user.get('last_name', '')
+    first_name = user.first_name or ''
+    last_name = user.last_name or ''
     full_name = f"{first_name} {last_name}".strip() if first_name or last_name else "Не вказано"
     
-    limit_info = "♾️ Необмежено" if (user["premium"]["active"] or user_id == ADMIN_ID) else f"{user['used']}/{FREE_LIMIT}"
+    limit_info = "♾️ Необмежено" if (user.premium_active or user_id == ADMIN_ID) else f"{user.used}/{FREE_LIMIT}"
     
-    profile_text = f"📊 <b>Профіль:</b>\n\n🆔 ID: {user_id}\n👤 Ім'я: {full_name}\n📱 Username: {username}\n🎭 Роль: {role}\n💎 Преміум: {premium_status}\n💬 Використано сьогодні: {user['used']}\n🔋 Ліміт: {limit_info}\n⏰ Оновлення: опівночі (за київським часом)\n\n🐞 Техпідтримка: {SUPPORT_USERNAME}"
+    profile_text = f"📊 <b>Профіль:</b>\n\n🆔 ID: {user_id}\n👤 Ім'я: {full_name}\n📱 Username: {username}\n🎭 Роль: {role}\n💎 Преміум: {premium_status}\n💬 Використано сьогодні: {user.used}\n🔋 Ліміт: {limit_info}\n⏰ Оновлення: опівночі (за київським часом)\n\n🐞 Техпідтримка: {SUPPORT_USERNAME}"
     bot.reply_to(message, profile_text, parse_mode="HTML")
 
 @bot.message_handler(commands=["premium"])
@@ -553,37 +2468,41 @@ def process_promo(message):
     user_id = message.from_user.id
     promo = message.text.strip().upper()
     
-    if promo in promo_codes:
-        code_data = promo_codes[promo]
-        if code_data["uses_left"] > 0:
-            if code_data["seconds"] == 0:
-                user_data[user_id]["premium"] = {"active": True, "until": None}
-            else:
-                if user_data[user_id]["premium"]["active"]:
-                    current_until = user_data[user_id]["premium"]["until"]
-                    if current_until is None:
-                        bot.reply_to(message, "❌ У вас вже є безстроковий преміум!")
-                        return
-                    if isinstance(current_until, str):
-                        current_until = datetime.datetime.fromisoformat(current_until)
-                        if current_until.tzinfo is None:
-                            current_until = UKRAINE_TZ.localize(current_until)
-                    new_until = current_until + datetime.timedelta(seconds=code_data["seconds"])
-                else:
-                    new_until = get_ukraine_time() + datetime.timedelta(seconds=code_data["seconds"])
-                user_data[user_id]["premium"] = {"active": True, "until": new_until}
-            
-            code_data["uses_left"] -= 1
-            save_data()
-            
-            if code_data["seconds"] == 0:
-                bot.reply_to(message, "✅ Безстроковий преміум активовано! ♾️")
-            else:
-                bot.reply_to(message, f"✅ Преміум активовано до {new_until.astimezone(UKRAINE_TZ).strftime('%d.%m.%Y %H:%M')}!")
-        else:
-            bot.reply_to(message, "❌ Промокод вичерпано!")
-    else:
+    user = user_data.get(user_id) or create_user(user_id, message.from_user.username, message.from_user.first_name, message.from_user.last_name)
+    if user.premium_active and user.premium_until is None:
+        bot.reply_to(message, "❌ У вас вже є безстроковий преміум!")
+        return
+    
+    try:
+        status, seconds = promo_store.redeem(promo, user_id)
+    except Exception as e:
+        print(f"❌ Помилка активації промокоду: {e}")
+        bot.reply_to(message, "❌ Не вдалося активувати промокод. Спробуйте пізніше!")
+        return
+    
+    if status == "invalid":
         bot.reply_to(message, "❌ Невірний промокод!")
+        return
+    if status == "exhausted":
+        bot.reply_to(message, "❌ Промокод вичерпано!")
+        return
+    if status == "used":
+        bot.reply_to(message, "❌ Ви вже використали цей промокод!")
+        return
+    
+    if seconds == 0:
+        user.set_premium(True)
+        mark_user_dirty(user_id, "premium")
+        bot.reply_to(message, "✅ Безстроковий преміум активовано! ♾️")
+        return
+    if user.premium_active:
+        new_until = user.premium_until + datetime.timedelta(seconds=seconds)
+    else:
+        new_until = get_ukraine_time() + datetime.timedelta(seconds=seconds)
+    user.set_premium(True, new_until)
+    mark_user_dirty(user_id, "premium")
+    schedule_premium_expiry(user)
+    bot.reply_to(message, f"✅ Преміум активовано до {new_until.astimezone(UKRAINE_TZ).strftime('%d.%m.%Y %H:%M')}!")
 
 @bot.message_handler(func=lambda m: m.text == "💳 Купити преміум")
 def buy_premium(message):
@@ -609,16 +2528,12 @@ def bot_management(message):
 
 @bot.message_handler(func=lambda m: m.text == "🔴 Вимкнути бота" and m.from_user.id == ADMIN_ID)
 def disable_bot(message):
-    global BOT_ENABLED
-    BOT_ENABLED = False
-    save_data()
+    set_bot_enabled(False)
     bot.reply_to(message, "🔴 Бот вимкнений для всіх користувачів крім адміністратора!", reply_markup=bot_management_keyboard())
 
 @bot.message_handler(func=lambda m: m.text == "🟢 Увімкнути бота" and m.from_user.id == ADMIN_ID)
 def enable_bot(message):
-    global BOT_ENABLED
-    BOT_ENABLED = True
-    save_data()
+    set_bot_enabled(True)
     bot.reply_to(message, "🟢 Бot увімкнений для всіх користувачів!", reply_markup=bot_management_keyboard())
 
 @bot.message_handler(func=lambda m: m.text == "📊 Статус бота" and m.from_user.id == ADMIN_ID)
@@ -626,6 +2541,188 @@ def bot_status(message):
     status = "🟢 Увімкнений" if BOT_ENABLED else "🔴 Вимкнений"
     bot.reply_to(message, f"📊 <b>Статус бота:</b> {status}", parse_mode="HTML", reply_markup=bot_management_keyboard())
 
+class Broadcaster:
+    """Розсилка всім користувачам у фоновому потоці: рівномірний темп, пауза на 429 і контрольні точки в MongoDB для відновлення."""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.job = None
+        self.cancelled = False
+        self.next_slot = 0
+
+    def start(self, text, chat_id):
+        job = {
+            "_id": get_ukraine_time().strftime("%Y%m%d%H%M%S"), "text": text, "chat_id": chat_id, "status": "running",
+            "last_id": None, "sent": 0, "blocked": 0, "failed": 0, "progress_message_id": None,
+            "lease_until": time.time() + BROADCAST_LEASE,
+        }
+        with self.lock:
+            if self.job is not None:
+                return False
+            self.job, self.cancelled = job, False
+        if broadcasts_collection is not None:
+            broadcasts_collection.insert_one(job)
+        threading.Thread(target=self.run, args=(job,), daemon=True).start()
+        return True
+
+    def resume(self):
+        """Підхоплює незавершену розсилку, якщо її власник (ця чи інша репліка) перестав оновлювати оренду."""
+        if broadcasts_collection is None or self.job is not None:
+            return
+        try:
+            job = broadcasts_collection.find_one_and_update(
+                {"status": "running", "lease_until": {"$lt": time.time()}},
+                {"$set": {"lease_until": time.time() + BROADCAST_LEASE}},
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+        except Exception as e:
+            print(f"❌ Помилка відновлення розсилки: {e}")
+            return
+        if job is None:
+            return
+        with self.lock:
+            if self.job is not None:
+                return
+            self.job, self.cancelled = job, False
+        print(f"✅ Відновлено розсилку {job['_id']} після користувача {job['last_id']}")
+        threading.Thread(target=self.run, args=(job,), daemon=True).start()
+
+    def cancel(self):
+        with self.lock:
+            if self.job is None:
+                return False
+            self.cancelled = True
+            return True
+
+    def batches(self, last_id):
+        if users_collection is None:
+            ids = sorted(u.id for u in user_data.cached() if last_id is None or u.id > last_id)
+            for i in range(0, len(ids), BROADCAST_BATCH):
+                yield ids[i:i + BROADCAST_BATCH]
+            return
+        while True:
+            query = {} if last_id is None else {"_id": {"$gt": last_id}}
+            ids = [doc["_id"] for doc in users_collection.find(query, {"_id": 1}).sort("_id", pymongo.ASCENDING).limit(BROADCAST_BATCH)]
+            if not ids:
+                return
+            yield ids
+            last_id = ids[-1]
+
+    def throttle(self):
+        now = self.clock()
+        if self.next_slot > now:
+            self.sleep(self.next_slot - now)
+            now = self.next_slot
+        self.next_slot = now + self.interval
+
+    def send(self, user_id, text):
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            self.throttle()
+            try:
+                bot.send_message(user_id, text)
+                return "sent"
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    # Telegram просить зачекати — пауза для всієї розсилки, а не лише для цього чату
+                    retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 5)
+                    self.next_slot = self.clock() + retry_after
+                    continue
+                if e.error_code in (400, 403):
+                    return "blocked"
+                return "failed"
+            except Exception:
+                return "failed"
+        return "failed"
+
+    def checkpoint(self, job):
+        if broadcasts_collection is None:
+            return
+        job["lease_until"] = time.time() + BROADCAST_LEASE
+        fields = ("status", "last_id", "sent", "blocked", "failed", "progress_message_id", "lease_until")
+        broadcasts_collection.update_one({"_id": job["_id"]}, {"$set": {f: job[f] for f in fields}})
+
+    def report(self, job):
+        labels = {"running": "⏳ Триває", "done": "✅ Завершено", "cancelled": "⛔ Зупинено"}
+        text = f"📢 <b>Розсилка {job['_id']}:</b> {labels.get(job['status'], job['status'])}\n\n✉️ Надіслано: {job['sent']}\n🚫 Заблокували бота: {job['blocked']}\n❌ Помилок: {job['failed']}"
+        try:
+            if job["progress_message_id"]:
+                bot.edit_message_text(text, job["chat_id"], job["progress_message_id"], parse_mode="HTML")
+            else:
+                job["progress_message_id"] = bot.send_message(job["chat_id"], text, parse_mode="HTML").message_id
+        except Exception:
+            pass
+
+    def run(self, job):
+        last_report = self.clock()
+        try:
+            self.report(job)
+            for ids in self.batches(job["last_id"]):
+                for user_id in ids:
+                    if self.cancelled:
+                        break
+                    job[self.send(user_id, job["text"])] += 1
+                    job["last_id"] = user_id
+                if self.cancelled:
+                    job["status"] = "cancelled"
+                    break
+                self.checkpoint(job)
+                if self.clock() - last_report >= BROADCAST_REPORT_INTERVAL:
+                    self.report(job)
+                    last_report = self.clock()
+            else:
+                job["status"] = "done"
+            self.checkpoint(job)
+            self.report(job)
+        except Exception as e:
+            # Статус лишається running — розсилку підхопить resume після закінчення оренди
+            print(f"❌ Помилка розсилки: {e}")
+        finally:
+            with self.lock:
+                self.job = None
+
+    def status(self):
+        job = self.job
+        if job is None:
+            return "📢 Розсилка: немає активної"
+        return f"📢 Розсилка {job['_id']}: надіслано {job['sent']}, заблокували {job['blocked']}, помилок {job['failed']}"
+
+broadcaster = Broadcaster(BROADCAST_RATE)
+
+def resume_broadcasts():
+    broadcaster.resume()
+    scheduler.schedule(scheduler.clock() + BROADCAST_LEASE, resume_broadcasts)
+
+@bot.message_handler(func=lambda m: m.text == "📢 Розсилка" and m.from_user.id == ADMIN_ID)
+def broadcast_prompt(message):
+    if broadcaster.job is not None:
+        bot.reply_to(message, f"{broadcaster.status()}\n\n⛔ Зупинити: /stopbroadcast")
+        return
+    bot.reply_to(message, "📢 Введіть текст повідомлення для всіх користувачів (або /cancel):")
+    bot.register_next_step_handler(message, process_broadcast)
+
+def process_broadcast(message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if not message.text or message.text.strip() == "/cancel":
+        bot.reply_to(message, "❌ Розсилку скасовано", reply_markup=admin_keyboard())
+        return
+    if broadcaster.start(message.text, message.chat.id):
+        bot.reply_to(message, "✅ Розсилку розпочато! Прогрес оновлюватиметься в окремому повідомленні.\n⛔ Зупинити: /stopbroadcast", reply_markup=admin_keyboard())
+    else:
+        bot.reply_to(message, "❌ Інша розсилка ще триває!", reply_markup=admin_keyboard())
+
+@bot.message_handler(commands=["stopbroadcast"])
+def stop_broadcast(message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if broadcaster.cancel():
+        bot.reply_to(message, "⛔ Розсилку буде зупинено після поточного повідомлення")
+    else:
+        bot.reply_to(message, "❌ Немає активної розсилки")
+
 @bot.message_handler(func=lambda m: m.text == "🔙 До адмін панелі" and m.from_user.id == ADMIN_ID)
 def back_to_admin(message):
     bot.reply_to(message, "⚙️ <b>Адмін панель:</b>", parse_mode="HTML", reply_markup=admin_keyboard())
@@ -636,31 +2733,114 @@ def back_to_main(message):
         return
     bot.reply_to(message, "🏠 <b>Головне меню:</b>", parse_mode="HTML", reply_markup=main_menu())
 
+def format_user_line(data):
+    premium_status = "✅" if data.premium_active else "❌"
+    username = data.username
+    if not username:
+        username_display = "немає"
+    else:
+        username_display = "@" + username
+    first_name = data.first_name or ''
+    last_name = data.last_name or ''
+    if first_name or last_name:
+        name_display = f"{first_name} {last_name}".strip()
+        user_display = f"{name_display} ({username_display})"
+    else:
+        user_display = username_display
+    return f"ID: {data.id} | {user_display} | Преміум: {premium_status} | Використано: {data.used}\n"
+
+def encode_cursor(user_id):
+    return f"i{user_id}" if isinstance(user_id, int) else f"s{user_id}"
+
+def decode_cursor(cursor):
+    return int(cursor[1:]) if cursor[0] == "i" else cursor[1:]
+
+def users_page(direction="next", cursor=None):
+    """Сторінка користувачів, відсортованих за _id, починаючи після (або перед) курсором."""
+    if users_collection is not None:
+        save_data()
+        query = {}
+        if cursor is not None:
+            query = {"_id": {"$gt" if direction == "next" else "$lt": cursor}}
+        order = pymongo.ASCENDING if direction == "next" else pymongo.DESCENDING
+        docs = list(users_collection.find(query).sort("_id", order).limit(USERS_PAGE_SIZE + 1))
+        users = [UserRecord.from_doc(doc) for doc in docs]
+    else:
+        # Порядок як у MongoDB: спочатку числові _id, потім рядкові
+        sort_key = lambda user_id: (1, user_id, 0) if isinstance(user_id, str) else (0, "", user_id)
+        ordered = sorted(user_data.cached(), key=lambda u: sort_key(u.id))
+        if cursor is not None:
+            if direction == "next":
+                ordered = [u for u in ordered if sort_key(u.id) > sort_key(cursor)]
+            else:
+                ordered = [u for u in ordered if sort_key(u.id) < sort_key(cursor)]
+        users = ordered if direction == "next" else ordered[::-1]
+        users = users[:USERS_PAGE_SIZE + 1]
+    has_more = len(users) > USERS_PAGE_SIZE
+    users = users[:USERS_PAGE_SIZE]
+    if direction == "prev":
+        users.reverse()
+    has_prev = cursor is not None if direction == "next" else has_more
+    has_next = has_more if direction == "next" else True
+    return users, has_prev, has_next
+
+def users_page_view(direction="next", cursor=None):
+    users, has_prev, has_next = users_page(direction, cursor)
+    total_users = users_collection.estimated_document_count() if users_collection is not None else len(user_data)
+    users_text = "👥 <b>Список користувачів:</b>\n\n" + "".join(format_user_line(u) for u in users)
+    users_text += f"\n📊 Всього користувачів: {total_users}"
+    keyboard = InlineKeyboardMarkup()
+    buttons = []
+    if users and has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"users_prev_{encode_cursor(users[0].id)}"))
+    if users and has_next:
+        buttons.append(InlineKeyboardButton("Далі ➡️", callback_data=f"users_next_{encode_cursor(users[-1].id)}"))
+    if buttons:
+        keyboard.row(*buttons)
+    return users_text, keyboard
+
 @bot.message_handler(func=lambda m: m.text == "👥 Список користувачів" and m.from_user.id == ADMIN_ID)
 def user_list(message):
-    users_text = "👥 <b>Список користувачів:</b>\n\n"
-    for uid, data in list(user_data.items())[:50]:
-        premium_status = "✅" if data["premium"]["active"] else "❌"
-        username = data.get('username', '')
-        if not username:
-            username_display = "немає"
-        else:
-            username_display = "@" + username
-        first_name = data.get('first_name', '')
-        last_name = data.get('last_name', '')
-        if first_name or last_name:
-            name_display = f"{first_name} {last_name}".strip()
-            user_display = f"{name_display} ({username_display})"
-        else:
-            user_display = username_display
-        users_text += f"ID: {uid} | {user_display} | Преміум: {premium_status} | Використано: {data['used']}\n"
-    users_text += f"\n📊 Всього користувачів: {len(user_data)}"
-    bot.reply_to(message, users_text, parse_mode="HTML")
+    users_text, keyboard = users_page_view()
+    bot.reply_to(message, users_text, parse_mode="HTML", reply_markup=keyboard)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("users_") and call.from_user.id == ADMIN_ID)
+def user_list_page(call):
+    _, direction, cursor = call.data.split("_", 2)
+    users_text, keyboard = users_page_view(direction, decode_cursor(cursor))
+    bot.edit_message_text(users_text, call.message.chat.id, call.message.message_id, parse_mode="HTML", reply_markup=keyboard)
+    bot.answer_callback_query(call.id)
+
+@bot.message_handler(func=lambda m: m.text == "🔍 Пошук користувача" and m.from_user.id == ADMIN_ID)
+def find_user_prompt(message):
+    bot.reply_to(message, "🔍 Введіть ID або username користувача:")
+    bot.register_next_step_handler(message, process_find_user)
+
+def process_find_user(message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    query = message.text.strip().lstrip("@")
+    if not query:
+        bot.reply_to(message, "❌ Порожній запит!")
+        return
+    if users_collection is not None:
+        save_data()
+        # Якірний регістрозалежний префікс — MongoDB обмежує ним діапазон індексу username_lc
+        conditions = [{"username_lc": {"$regex": f"^{re.escape(query.lower())}"}}]
+        if query.isdigit():
+            conditions += [{"_id": int(query)}, {"_id": query}]
+        users = [UserRecord.from_doc(doc) for doc in users_collection.find({"$or": conditions}).limit(USERS_PAGE_SIZE)]
+    else:
+        users = [u for u in user_data.cached() if str(u.id) == query or (u.username or "").lower().startswith(query.lower())][:USERS_PAGE_SIZE]
+    if not users:
+        bot.reply_to(message, "❌ Користувача не знайдено!")
+        return
+    bot.reply_to(message, "🔍 <b>Знайдено:</b>\n\n" + "".join(format_user_line(u) for u in users), parse_mode="HTML")
 
 @bot.message_handler(func=lambda m: m.text == "🎫 Керування промокодами" and m.from_user.id == ADMIN_ID)
 def manage_promos(message):
     promos_text = "🎫 <b>Промокоди:</b>\n\n"
-    for code, data in promo_codes.items():
+    for code, data in promo_store.all().items():
         promos_text += f"🔑 {code}: {data['uses_left']} використань | {format_time(data['seconds'])}\n"
     promos_text += "\n➕ Додати новий: /addpromo код час використань\n❌ Видалити: /removepromo код"
     bot.reply_to(message, promos_text, parse_mode="HTML")
@@ -677,8 +2857,7 @@ def add_promo(message):
         code = parts[1].upper()
         seconds = int(parts[2])
         uses = int(parts[3])
-        promo_codes[code] = {"seconds": seconds, "uses_left": uses}
-        save_data()
+        promo_store.add(code, seconds, uses)
         bot.reply_to(message, f"✅ Промокод {code} додано!")
     except:
         bot.reply_to(message, "❌ Помилка формату!")
@@ -689,9 +2868,7 @@ def remove_promo(message):
         return
     try:
         code = message.text.split()[1].upper()
-        if code in promo_codes:
-            del promo_codes[code]
-            save_data()
+        if promo_store.remove(code):
             bot.reply_to(message, f"✅ Промокод {code} видалено!")
         else:
             bot.reply_to(message, "❌ Промокод не знайдено!")
@@ -711,13 +2888,12 @@ def process_add_premium(message):
         username = message.from_user.username if message.from_user.username else f"user_{user_id}"
         first_name = message.from_user.first_name or ""
         last_name = message.from_user.last_name or ""
-        user_data[user_id] = {
-            "_id": user_id, "used": 0, "premium": {"active": True, "until": None},
-            "reset": get_ukraine_time().date().isoformat(), "history": [],
-            "free_used": False, "last_movie_query": None, "last_code": None,
-            "username": username, "first_name": first_name, "last_name": last_name
-        }
-        save_data()
+        # Наявного користувача не перестворюємо: це стерло б його дані й зарахувало ще одного "нового"
+        if user_id not in user_data:
+            create_user(user_id, username, first_name, last_name, premium_active=True)
+        else:
+            user_data[user_id].set_premium(True)
+            mark_user_dirty(user_id, "premium")
         bot.reply_to(message, f"✅ Безстроковий преміум надано користувачу {user_id}!")
         try:
             bot.send_message(user_id, f"🎉 Вітаю! Адміністратор надав вам безстроковий преміум доступ! ♾️\n\nТепер ви можете:\n• Робити необмежену кількість запитів\n• Отримувати пріоритетну обробку\n• Користуватись усіма перевагами преміуму\n\nЩоб перевірити статус: /profile")
@@ -747,15 +2923,11 @@ def process_timed_premium(message):
             return
         until_time = get_ukraine_time() + datetime.timedelta(seconds=seconds)
         if user_id not in user_data:
-            user_data[user_id] = {
-                "_id": user_id, "used": 0, "premium": {"active": True, "until": until_time},
-                "reset": get_ukraine_time().date().isoformat(), "history": [],
-                "free_used": False, "last_movie_query": None, "last_code": None,
-                "username": f"user_{user_id}", "first_name": "", "last_name": ""
-            }
+            create_user(user_id, f"user_{user_id}", "", "", premium_active=True, premium_until=until_time)
         else:
-            user_data[user_id]["premium"] = {"active": True, "until": until_time}
-        save_data()
+            user_data[user_id].set_premium(True, until_time)
+            mark_user_dirty(user_id, "premium")
+            schedule_premium_expiry(user_data[user_id])
         time_duration = format_time(seconds)
         bot.reply_to(message, f"✅ Преміум надано користувачу {user_id}!\n⏰ Тривалість: {time_duration}\n📅 До: {until_time.astimezone(UKRAINE_TZ).strftime('%d.%m.%Y %H:%M')}")
         try:
@@ -777,9 +2949,11 @@ def process_delete_user(message):
         user_id = int(message.text.strip())
         if user_id in user_data:
             del user_data[user_id]
-            if users_collection:
+            forget_user_changes(user_id)
+            if users_collection is not None:
                 users_collection.delete_one({"_id": user_id})
-            save_data()
+            elif journal is not None:
+                journal.log({"t": "user_del", "id": user_id})
             bot.reply_to(message, f"✅ Користувача {user_id} видалено!")
         else:
             bot.reply_to(message, "❌ Користувача не знайдено!")
@@ -788,126 +2962,960 @@ def process_delete_user(message):
 
 @bot.message_handler(func=lambda m: m.text == "📊 Статистика" and m.from_user.id == ADMIN_ID)
 def stats(message):
-    total_users = len(user_data)
-    premium_users = sum(1 for u in user_data.values() if u["premium"]["active"])
-    total_used = sum(u["used"] for u in user_data.values())
-    stats_text = f"📊 <b>Статистика:</b>\n\n👥 Користувачів: {total_users}\n💎 Преміум: {premium_users}\n🔢 Звичайних: {total_users - premium_users}\n💬 Запитів сьогодні: {total_used}\n🎫 Промокодів: {len(promo_codes)}"
+    daily_text = ""
+    if users_collection is not None:
+        save_data()
+        total_users = users_collection.estimated_document_count()
+        premium_users = users_collection.count_documents({"premium.active": True})
+        today = get_ukraine_time().date().isoformat()
+        days = list(daily_stats_collection.find().sort("_id", pymongo.DESCENDING).limit(7))
+        today_stats = days[0] if days and days[0]["_id"] == today else {}
+        total_used = today_stats.get("requests", 0)
+        daily_text = f"\n🆕 Нових сьогодні: {today_stats.get('new_users', 0)}\n\n📅 <b>Останні дні (запити / нові):</b>\n"
+        daily_text += "".join(f"{d['_id']}: {d.get('requests', 0)} / {d.get('new_users', 0)}\n" for d in days)
+    else:
+        users = user_data.cached()
+        total_users = len(users)
+        premium_users = sum(1 for u in users if u.premium_active)
+        total_used = sum(u.used for u in users)
+    stats_text = f"📊 <b>Статистика:</b>\n\n👥 Користувачів: {total_users}\n💎 Преміум: {premium_users}\n🔢 Звичайних: {total_users - premium_users}\n💬 Запитів сьогодні: {total_used}{daily_text}\n🎫 Промокодів: {promo_store.count()}\n🔍 Кеш пошуку: {search_cache.hits} влучань / {search_cache.misses} промахів ({search_cache.hit_rate():.0f}%)"
+    stats_text += f"\n\n🌐 <b>Upstream:</b>\n{gemini_client.status()}\n{search_client.status()}\n🔀 Шарди пошуку: таймаутів {search_stats['shard_timeouts']}, помилок {search_stats['shard_errors']}\n{movie_index.status()}\n{prefetcher.status()}"
+    by_kind = ", ".join(f"{kind}: {count}" for kind, count in response_cache_hits.items()) or "—"
+    stats_text += f"\n🧠 Кеш відповідей: {response_cache.hits} влучань / {response_cache.misses} промахів ({response_cache.hit_rate():.0f}%) | {by_kind}"
+    if gemini_ttft.count:
+        stats_text += f"\n⚡ Перший токен p50/p99: {gemini_ttft.percentile(50)}с / {gemini_ttft.percentile(99)}с"
+    stages = " | ".join(f"{stage} {h.percentile(50)}/{h.percentile(99)}с" for stage, h in stage_latency.items() if h.count)
+    if stages:
+        stats_text += f"\n⏱️ Етапи p50/p99: {stages}\n⏱️ Запит цілком p50/p99: {request_latency.percentile(50)}с / {request_latency.percentile(99)}с"
+    if gemini_usage["responses"]:
+        stats_text += f"\n🔤 Токени Gemini: вхід {gemini_usage['prompt']} / вихід {gemini_usage['output']} (у середньому {gemini_usage['prompt'] // gemini_usage['responses']} / {gemini_usage['output'] // gemini_usage['responses']})"
+    if prompt_tokens.count:
+        stats_text += f"\n🧾 Промпт p50/p99: ~{prompt_tokens.percentile(50):.0f} / ~{prompt_tokens.percentile(99):.0f} токенів | контекст у середньому ~{context_stats['context_tokens'] // prompt_tokens.count} токенів, поза бюджетом ~{context_stats['skipped_tokens'] // prompt_tokens.count}"
+    if context_stats["summaries"]:
+        stats_text += f"\n🗜️ Підсумків: {context_stats['summaries']} | стиснуто ~{context_stats['summarized_tokens']} → ~{max(context_stats['summary_tokens'], 0)} токенів"
+    stats_text += f"\n{quota.status()}"
+    if dispatcher is not None:
+        stats_text += f"\n📥 Черга: {dispatcher.pending} | Оброблено: {dispatcher.processed} | Відхилено: {dispatcher.rejected}\n⏱️ Очікування p50/p99: {dispatcher.wait_time.percentile(50)}с / {dispatcher.wait_time.percentile(99)}с"
     bot.reply_to(message, stats_text, parse_mode="HTML")
 
+class DumpReader:
+    """Потоково читає дамп користувачів: старий bot_data.json ({"user_data": {id: {...}}, ...}) або JSONL (документ на рядок).
+
+    Дублікати ключів не схлопуються, а пошкоджені фрагменти пропускаються й записуються в errors.
+    """
+
+    CHUNK = 1 << 16
+    MAX_FRAGMENT = 1 << 20
+    USER_KEY = re.compile(r'"\d+"\s*:\s*\{')
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.buf = ""
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self.errors = []
+
+    def fill(self):
+        chunk = self.fp.read(self.CHUNK)
+        if not chunk:
+            self.eof = True
+            return False
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n,":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, char):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+                return True, value
+            except json.JSONDecodeError as e:
+                truncated = e.pos >= len(self.buf) - 1 or e.msg.startswith("Unterminated")
+                if truncated and len(self.buf) - self.pos < self.MAX_FRAGMENT and self.fill():
+                    continue
+                return False, e
+
+    def resync(self):
+        """Переходить до наступного ключа користувача після пошкодженого фрагмента."""
+        while True:
+            match = self.USER_KEY.search(self.buf, self.pos + 1)
+            if match:
+                self.pos = match.start()
+                return True
+            if not self.fill():
+                return False
+
+    def error(self, position, reason):
+        self.errors.append(f"{position}: {reason}")
+
+    def records(self):
+        """Повертає пари (ключ, значення): ("user", документ) або (ключ верхнього рівня, значення)."""
+        first = self.fp.readline()
+        try:
+            doc = json.loads(first)
+        except ValueError:
+            doc = None
+        if isinstance(doc, dict) and "_id" in doc:
+            yield "user", doc
+            yield from self.jsonl_records()
+            return
+        self.buf = first
+        yield from self.legacy_records()
+
+    def jsonl_records(self):
+        for line_no, line in enumerate(self.fp, start=2):
+            if not line.strip():
+                continue
+            try:
+                doc = json.loads(line)
+            except ValueError as e:
+                self.error(f"рядок {line_no}", e)
+                continue
+            if isinstance(doc, dict) and "_id" in doc:
+                yield "user", doc
+            else:
+                self.error(f"рядок {line_no}", "немає _id")
+
+    def legacy_records(self):
+        if not self.expect("{"):
+            self.error(self.offset + self.pos, "очікувався об'єкт")
+            return
+        while self.peek() not in (None, "}"):
+            ok, key = self.value()
+            if not ok or not isinstance(key, str) or not self.expect(":"):
+                self.error(self.offset + self.pos, key if not ok else "очікувався ключ")
+                return
+            if key == "user_data":
+                if not (yield from self.user_entries()):
+                    return
+                continue
+            ok, value = self.value()
+            if not ok:
+                self.error(self.offset + self.pos, value)
+                return
+            yield key, value
+        if self.peek() is None:
+            self.error(self.offset + self.pos, "файл обірвано")
+
+    def user_entries(self):
+        """Повертає False, якщо далі читати нема чого (файл обірвано)."""
+        if not self.expect("{"):
+            self.error(self.offset + self.pos, "user_data не є об'єктом")
+            return False
+        while True:
+            char = self.peek()
+            if char is None:
+                self.error(self.offset + self.pos, "файл обірвано посеред user_data")
+                return False
+            if char == "}":
+                self.pos += 1
+                return True
+            start = self.offset + self.pos
+            ok, key = self.value()
+            if ok and isinstance(key, str) and self.expect(":"):
+                ok, doc = self.value()
+                if ok and isinstance(doc, dict):
+                    yield "user", dict(doc, _id=key)
+                    continue
+                reason = doc if not ok else "запис не є об'єктом"
+            else:
+                reason = key if not ok else "очікувався ключ"
+            self.error(start, reason)
+            if not self.resync():
+                return False
+
+def premium_rank(premium):
+    if not premium.get("active"):
+        return (0, 0)
+    if premium.get("until") is None:
+        return (2, 0)
+    return (1, parse_datetime(premium["until"]).timestamp())
+
+def merge_user_docs(a, b):
+    """Злиття дублікатів: перемагає активний преміум з найпізнішим until, решта полів — з новішого запису."""
+    newer, older = (a, b) if (a.get("reset") or "") >= (b.get("reset") or "") else (b, a)
+    merged = dict(older)
+    merged.update({key: value for key, value in newer.items() if value is not None})
+    merged["premium"] = max(a["premium"], b["premium"], key=premium_rank)
+    if a.get("reset") == b.get("reset"):
+        merged["used"] = max(a.get("used", 0), b.get("used", 0))
+    return merged
+
+def normalize_user_doc(doc):
+    user = UserRecord.from_doc(dict(doc, _id=int(doc["_id"])))
+    # Преміум, що закінчився, поки запис лежав у дампі, не повинен перемогти при злитті
+    if user.premium_active and user.premium_until is not None and user.premium_until.timestamp() <= time.time():
+        user.set_premium(False)
+    return user.to_doc()
+
+def import_dump(fp):
+    """Імпортує дамп пачками по IMPORT_BATCH: дублікати зливаються між собою та з наявними записами."""
+    save_data()
+    reader = DumpReader(fp)
+    stats = collections.Counter()
+    batch = {}
+
+    def flush():
+        if users_collection is not None:
+            for existing in users_collection.find({"_id": {"$in": list(batch)}}):
+                batch[existing["_id"]] = merge_user_docs(normalize_user_doc(existing), batch[existing["_id"]])
+                stats["merged"] += 1
+            users_collection.bulk_write([pymongo.ReplaceOne({"_id": user_id}, doc, upsert=True) for user_id, doc in batch.items()], ordered=False)
+            for user_id in batch:
+                # Кешована копія застаріла — наступне звернення перечитає запис із бази
+                if user_data.peek(user_id) is not None:
+                    del user_data[user_id]
+        else:
+            for user_id, doc in batch.items():
+                existing = user_data.peek(user_id)
+                if existing is not None:
+                    doc = merge_user_docs(existing.to_doc(), doc)
+                    stats["merged"] += 1
+                user_data[user_id] = UserRecord.from_doc(doc)
+                mark_user_dirty(user_id)
+        for doc in batch.values():
+            schedule_premium_expiry(UserRecord.from_doc(doc))
+        stats["imported"] += len(batch)
+        batch.clear()
+
+    known_promos = None
+    for key, value in reader.records():
+        if key == "user":
+            try:
+                doc = normalize_user_doc(value)
+            except (TypeError, ValueError, AttributeError) as e:
+                reader.error(f"користувач {value.get('_id')}", e)
+                continue
+            user_id = doc["_id"]
+            if user_id in batch:
+                batch[user_id] = merge_user_docs(batch[user_id], doc)
+                stats["duplicates"] += 1
+            else:
+                batch[user_id] = doc
+            if len(batch) >= IMPORT_BATCH:
+                flush()
+        elif key == "promo_codes" and isinstance(value, dict):
+            known_promos = known_promos if known_promos is not None else set(promo_store.all())
+            for code, data in value.items():
+                if code not in known_promos:
+                    promo_store.add(code, data["seconds"], data["uses_left"])
+                    known_promos.add(code)
+                    stats["promos"] += 1
+    if batch:
+        flush()
+    return stats, reader.errors
+
+def export_users(fp):
+    """Пише всіх користувачів у JSONL (документ на рядок) — формат, який приймає import_dump.
+    Повертає (кількість, помилки); записи, які не вдалося нормалізувати (напр. нечисловий _id), пропускаються."""
+    save_data()
+    count, errors = 0, []
+    if users_collection is not None:
+        docs = users_collection.find().sort("_id", pymongo.ASCENDING).batch_size(IMPORT_BATCH)
+    else:
+        docs = (user.to_doc() for user in user_data.cached())
+    for doc in docs:
+        try:
+            doc = normalize_user_doc(doc)
+        except (TypeError, ValueError, AttributeError) as e:
+            errors.append(f"користувач {doc.get('_id')!r}: {e}")
+            continue
+        fp.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        count += 1
+    return count, errors
+
+def export_report(count, errors):
+    text = f"💾 Експортовано {count} користувачів"
+    if errors:
+        text += f"\n⚠️ Пропущено записів: {len(errors)}\n" + "\n".join(str(e)[:120] for e in errors[:5])
+    return text
+
+def import_report(stats, errors):
+    text = f"✅ Імпортовано: {stats['imported']} користувачів\n🔁 Дублікатів у файлі злито: {stats['duplicates']}\n🔗 Злито з наявними: {stats['merged']}\n🎫 Нових промокодів: {stats['promos']}"
+    if errors:
+        text += f"\n⚠️ Пропущено пошкоджених фрагментів: {len(errors)}\n" + "\n".join(str(e)[:120] for e in errors[:5])
+    return text
+
+@bot.message_handler(commands=["export"])
+def export_command(message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    try:
+        with tempfile.TemporaryFile("w+b") as f:
+            text = io.TextIOWrapper(f, encoding="utf-8")
+            count, errors = export_users(text)
+            text.flush()
+            f.seek(0)
+            # Підпис документа обмежений 1024 символами
+            bot.send_document(message.chat.id, telebot.types.InputFile(f, file_name=f"users_{get_ukraine_time().strftime('%Y%m%d_%H%M')}.jsonl"), caption=export_report(count, errors)[:1024])
+            text.detach()
+    except Exception as e:
+        print(f"❌ Помилка експорту: {e}")
+        bot.reply_to(message, f"❌ Помилка експорту: {e}")
+
+@bot.message_handler(commands=["import"])
+def import_usage(message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    bot.reply_to(message, "📥 Надішліть файл дампу (bot_data.json або .jsonl) з підписом /import\n\nВеликі дампи: python bot.py import шлях_до_файлу")
+
+@bot.message_handler(content_types=["document"], func=lambda m: m.from_user.id == ADMIN_ID and (m.caption or "").startswith("/import"))
+def import_command(message):
+    try:
+        data = bot.download_file(bot.get_file(message.document.file_id).file_path)
+        stats, errors = import_dump(io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", errors="replace"))
+        bot.reply_to(message, import_report(stats, errors))
+    except Exception as e:
+        bot.reply_to(message, f"❌ Помилка імпорту: {e}")
+
+def merge_string_ids():
+    """Старі записи могли потрапити в базу з _id-рядком поруч із числовим — зливаємо їх у числовий."""
+    merged = 0
+    for doc in users_collection.find({"_id": {"$type": "string"}}):
+        try:
+            user_id = int(doc["_id"])
+        except ValueError:
+            continue
+        fresh = normalize_user_doc(doc)
+        existing = users_collection.find_one({"_id": user_id})
+        if existing is not None:
+            fresh = merge_user_docs(normalize_user_doc(existing), fresh)
+        users_collection.replace_one({"_id": user_id}, fresh, upsert=True)
+        users_collection.delete_one({"_id": doc["_id"]})
+        if user_data.peek(user_id) is not None:
+            del user_data[user_id]
+        merged += 1
+    return merged
+
 @bot.message_handler(commands=["clearduplicates"])
 def clear_duplicates(message):
     if message.from_user.id != ADMIN_ID:
         return
-    unique_users = {}
-    duplicates_removed = 0
-    for uid, data in user_data.items():
-        if uid not in unique_users:
-            unique_users[uid] = data
-        else:
-            duplicates_removed += 1
-    user_data.clear()
-    user_data.update(unique_users)
     save_data()
-    bot.reply_to(message, f"✅ Видалено {duplicates_removed} дублікатів! Залишилось {len(user_data)} унікальних користувачів")
+    duplicates_removed = merge_string_ids() if users_collection is not None else 0
+    total_users = users_collection.count_documents({}) if users_collection is not None else len(user_data)
+    bot.reply_to(message, f"✅ Видалено {duplicates_removed} дублікатів! Залишилось {total_users} унікальних користувачів")
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("copy_"))
 def copy_code(call):
-    code_hash = call.data[5:]
-    for user in user_data.values():
-        if user["last_code"] and hash(user["last_code"]) == int(code_hash):
-            bot.answer_callback_query(call.id, "📋 Код скопійовано в буфер обміну!")
-            return
-    bot.answer_callback_query(call.id, "❌ Код вже не актуальний!")
+    code = snippet_store.get(call.data[5:])
+    if code is None:
+        bot.answer_callback_query(call.id, "❌ Код вже не актуальний!")
+        return
+    bot.answer_callback_query(call.id, "📋 Надсилаю код для копіювання")
+    if len(code) <= TELEGRAM_MESSAGE_LIMIT:
+        bot.send_message(call.message.chat.id, code)
+    else:
+        bot.send_document(call.message.chat.id, telebot.types.InputFile(io.BytesIO(code.encode()), file_name="code.txt"))
 
 @bot.message_handler(func=lambda m: True)
 def handle_message(message):
+    if dispatcher is None:
+        process_message(message)
+    elif not dispatcher.submit(message):
+        bot.reply_to(message, "⏳ Бот зараз перевантажений. Спробуйте ще раз за хвилину!")
+
+class QuotaLimiter:
+    """Денний ліміт списується атомарно в MongoDB ($inc з умовою), серії запитів з одного чату обмежуються ковзним вікном."""
+
+    TRACKED_CHATS = 10000
+
+    def __init__(self, limit, burst_limit, burst_window, clock=time.monotonic):
+        self.limit = limit
+        self.burst_limit = burst_limit
+        self.burst_window = burst_window
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.recent = {}
+        self.counters = collections.Counter()
+
+    @property
+    def atomic(self):
+        return QUOTA_ATOMIC and users_collection is not None
+
+    def allow_burst(self, chat_id):
+        if self.burst_limit <= 0:
+            return True
+        now = self.clock()
+        with self.lock:
+            window = self.recent.get(chat_id)
+            if window is None:
+                if len(self.recent) >= self.TRACKED_CHATS:
+                    self.recent = {c: w for c, w in self.recent.items() if w and w[-1] > now - self.burst_window}
+                window = self.recent[chat_id] = collections.deque()
+            while window and window[0] <= now - self.burst_window:
+                window.popleft()
+            if len(window) >= self.burst_limit:
+                self.counters["burst_denied"] += 1
+                return False
+            window.append(now)
+        return True
+
+    def roll_day(self, user):
+        today = current_day()
+        if user.reset != today:
+            user.used = 0
+            user.reset = today
+            # При атомарному обліку лічильник у базі скидає сам запит на списання
+            if not self.atomic:
+                mark_user_dirty(user.id, "used", "reset")
+
+    def consume(self, user, enforce=True):
+        """Списує один запит. Повертає False, якщо денний ліміт вичерпано."""
+        self.roll_day(user)
+        if self.atomic:
+            allowed = self.consume_atomic(user, enforce)
+            if allowed is not None:
+                self.counters["allowed" if allowed else "quota_denied"] += 1
+                return allowed
+            self.counters["fallback"] += 1
+        with self.lock:
+            allowed = not enforce or user.used < self.limit
+            if allowed:
+                inc_user_field(user.id, "used")
+        self.counters["allowed" if allowed else "quota_denied"] += 1
+        return allowed
+
+    def consume_atomic(self, user, enforce):
+        """Повертає None, якщо документа користувача ще немає в базі або база недоступна."""
+        today = datetime.date.fromordinal(current_day()).isoformat()
+        query = {"_id": user.id, "reset": today}
+        if enforce:
+            query["used"] = {"$lt": self.limit}
+        try:
+            doc = users_collection.find_one_and_update(query, {"$inc": {"used": 1}}, projection={"used": 1}, return_document=pymongo.ReturnDocument.AFTER)
+            if doc is None:
+                # Перший запит доби: лічильник у базі ще не скинуто
+                doc = users_collection.find_one_and_update(
+                    {"_id": user.id, "reset": {"$ne": today}}, {"$set": {"used": 1, "reset": today}},
+                    projection={"used": 1}, return_document=pymongo.ReturnDocument.AFTER
+                )
+            if doc is None:
+                # Добу щойно скинув паралельний запит (або інша репліка) — списуємо ще раз уже з умовою ліміту
+                doc = users_collection.find_one_and_update(query, {"$inc": {"used": 1}}, projection={"used": 1}, return_document=pymongo.ReturnDocument.AFTER)
+            if doc is None:
+                doc = users_collection.find_one({"_id": user.id}, {"used": 1})
+                if doc is None:
+                    return None
+                user.used = doc.get("used", 0)
+                return False
+        except Exception as e:
+            print(f"❌ Помилка атомарного списання ліміту: {e}")
+            return None
+        user.used = doc["used"]
+        return True
+
+    def status(self):
+        c = self.counters
+        mode = "атомарно" if self.atomic else "локально"
+        return f"🚦 Ліміти ({mode}): дозволено {c['allowed']} | ліміт {c['quota_denied']} | серії {c['burst_denied']} | резерв {c['fallback']}"
+
+quota = QuotaLimiter(FREE_LIMIT, BURST_LIMIT, BURST_WINDOW)
+
+def accept_message(message):
+    """Оновлює дані користувача та перевіряє ліміт. Повертає статус преміуму або None, якщо запит відхилено."""
     if not check_bot_enabled(message):
-        return
+        return None
     user_id = message.from_user.id
     
     if user_id not in user_data:
-        user_data[user_id] = {
-            "_id": user_id, "used": 0, "premium": {"active": False, "until": None},
-            "reset": get_ukraine_time().date().isoformat(), "history": [],
-            "free_used": False, "last_movie_query": None, "last_code": None,
-            "username": message.from_user.username, "first_name": message.from_user.first_name,
-            "last_name": message.from_user.last_name
-        }
-        save_data()
+        create_user(user_id, message.from_user.username, message.from_user.first_name, message.from_user.last_name)
     else:
-        user_data[user_id]["username"] = message.from_user.username
-        user_data[user_id]["first_name"] = message.from_user.first_name
-        user_data[user_id]["last_name"] = message.from_user.last_name
-        save_data()
+        update_user_profile(user_id, message.from_user)
     
     user = user_data[user_id]
-    today = get_ukraine_time().date()
     
-    if isinstance(user["reset"], str):
-        reset_date = datetime.date.fromisoformat(user["reset"])
-    else:
-        reset_date = user["reset"]
-    
-    if reset_date != today:
-        user["used"] = 0
-        user["reset"] = today.isoformat()
-        save_data()
-    
-    if user["premium"]["active"] and user["premium"]["until"] is not None:
-        if isinstance(user["premium"]["until"], str):
-            until_date = datetime.datetime.fromisoformat(user["premium"]["until"])
-            if until_date.tzinfo is None:
-                until_date = UKRAINE_TZ.localize(until_date)
-        else:
-            until_date = user["premium"]["until"]
-        
-        if until_date < get_ukraine_time():
-            user["premium"] = {"active": False, "until": None}
-            save_data()
+    if user_id != ADMIN_ID and not quota.allow_burst(message.chat.id):
+        bot.reply_to(message, "⏳ Забагато запитів поспіль. Зачекайте кілька секунд!")
+        return None
     
-    is_premium = user["premium"]["active"] or user_id == ADMIN_ID
-    if not is_premium and user["used"] >= FREE_LIMIT:
-        if not user["free_used"]:
-            user["free_used"] = True
-            save_data()
+    # Скидання ліміту й завершення преміуму виконує планувальник; тут лише списання запиту
+    is_premium = user.premium_active or user_id == ADMIN_ID
+    if not quota.consume(user, enforce=not is_premium):
+        if not user.free_used:
+            user.free_used = True
+            mark_user_dirty(user_id, "free_used")
             bot.reply_to(message, f"❌ Ви вичерпали безкоштовний ліміт ({FREE_LIMIT} запитів на день).\n\n💎 Отримайте преміум для необмежених запитів!", reply_markup=premium_menu_keyboard())
         else:
             bot.reply_to(message, f"❌ Ліміт вичерпано! Спробуйте завтра або отримайте преміум 💎", reply_markup=premium_menu_keyboard())
-        return
-    
-    user["used"] += 1
-    user["history"].append(message.text)
-    if len(user["history"]) > 10:
-        user["history"].pop(0)
+        return None
     
-    save_data()
+    count_daily("requests")
     
-    question = message.text.lower()
-    is_movie_query = any(word in question for word in movie_keywords) and not any(word in question for word in code_keywords)
-    is_code_query = any(word in question for word in code_keywords) and not any(word in question for word in movie_keywords)
+    return is_premium
+
+def remember_movie_query(user_id, text):
+    user_data[user_id].last_movie_query = text
+    mark_user_dirty(user_id, "last_movie_query")
+    trending.observe(text)
+
+def search_results_text(prepared):
+    if not prepared.search_results or "🔍 Нічого не знайдено" in prepared.search_results:
+        return None
+    premium_status = " (преміум пошук)" if prepared.is_premium else ""
+    return f"🔍 <b>Результати пошуку{premium_status}:</b>\n\n{prepared.search_results}\n\n📝 <b>А ось детальна інформація:</b>"
+
+def finalize_response(prepared, response):
+    # Пише в MongoDB (фрагмент коду), тож async-режим викликає її через asyncio.to_thread
+    if prepared.kind == "code" and "```" in response:
+        user_data[prepared.user_id].last_code = response
+        mark_user_dirty(prepared.user_id, "last_code")
+        return "Markdown", create_copy_button(response)
+    return None, None
+
+def process_message(message):
+    with traced(message.from_user.id):
+        answer_message(message)
+
+def answer_message(message):
+    with span("quota"):
+        is_premium = accept_message(message)
+    if is_premium is None:
+        return
+    user_id = message.from_user.id
+    prepared = prepare_request(user_id, message.text, is_premium)
     
-    if is_movie_query:
-        user["last_movie_query"] = message.text
-        search_results = google_search(message.text, user_id)
-        if "🔍 Нічого не знайдено" not in search_results:
-            premium_status = " (преміум пошук)" if is_premium else ""
-            bot.reply_to(message, f"🔍 <b>Результати пошуку{premium_status}:</b>\n\n{search_results}\n\n📝 <b>А ось детальна інформація:</b>", parse_mode="HTML")
+    if prepared.kind == "movie":
+        remember_movie_query(user_id, message.text)
+        results_text = search_results_text(prepared)
+        if results_text:
+            bot.reply_to(message, results_text, parse_mode="HTML")
     
+    if STREAM_RESPONSES:
+        stream_reply(message, prepared)
+        return
     bot.send_chat_action(message.chat.id, "typing")
-    response = ask_gemini(user_id, message.text, user["history"])
+    with span("generation"):
+        response = ask_gemini(user_id, message.text, prepared=prepared)
+    parse_mode, markup = finalize_response(prepared, response)
+    with span("send"):
+        bot.reply_to(message, response, parse_mode=parse_mode, reply_markup=markup)
+    remember_exchange(prepared, response)
+
+class StreamEditor:
+    """Обмежує частоту редагувань повідомлення, що оновлюється під час генерації."""
+
+    def __init__(self):
+        self.last_edit = time.monotonic()
+        self.shown = ""
+
+    def next_preview(self, text):
+        now = time.monotonic()
+        if now - self.last_edit < STREAM_EDIT_INTERVAL or text == self.shown:
+            return None
+        self.last_edit = now
+        self.shown = text
+        return text[:TELEGRAM_MESSAGE_LIMIT - 2] + " ▌"
+
+    def backoff(self, error):
+        # Telegram повертає 429 з retry_after, якщо редагувати надто часто
+        retry_after = getattr(error, "result_json", {}).get("parameters", {}).get("retry_after")
+        if retry_after:
+            self.last_edit = time.monotonic() + retry_after
+
+def split_message(text):
+    return [text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)] or [text]
+
+def stream_reply(message, prepared):
+    cached = cached_response(prepared)
+    if cached is not None:
+        parse_mode, markup = finalize_response(prepared, cached)
+        bot.reply_to(message, cached, parse_mode=parse_mode, reply_markup=markup)
+        remember_exchange(prepared, cached)
+        return
+    sent = bot.reply_to(message, "⏳ Генерую відповідь...")
+    editor = StreamEditor()
+
+    def on_text(text):
+        preview = editor.next_preview(text)
+        if preview is None:
+            return
+        try:
+            bot.edit_message_text(preview, sent.chat.id, sent.message_id)
+        except Exception as e:
+            editor.backoff(e)
+
+    try:
+        with span("generation"):
+            response = stream_gemini(prepared, on_text)
+        store_response(prepared, response)
+    except Exception as e:
+        response = f"❌ Помилка: {e}"
+    parse_mode, markup = finalize_response(prepared, response)
+    chunks = split_message(response)
+    with span("send"):
+        try:
+            bot.edit_message_text(chunks[0], sent.chat.id, sent.message_id, parse_mode=parse_mode, reply_markup=markup if len(chunks) == 1 else None)
+        except Exception:
+            bot.edit_message_text(chunks[0], sent.chat.id, sent.message_id, reply_markup=markup if len(chunks) == 1 else None)
+        for i, chunk in enumerate(chunks[1:], start=2):
+            bot.send_message(message.chat.id, chunk, reply_markup=markup if i == len(chunks) else None)
+    remember_exchange(prepared, response)
+
+# Асинхронний режим (RUNTIME=async): AsyncTeleBot і спільні keep-alive сесії для Gemini та Custom Search
+async_bot = None
+async_sessions = {}
+
+def routes_to_chat(message):
+    if message.chat.id in bot.next_step_backend.handlers:
+        return False
+    for handler in bot.message_handlers:
+        if bot._test_message_handler(handler, message):
+            return handler["function"] is handle_message
+    return False
+
+async def async_search_shard(params):
+    # Повтори обмежує спільний дедлайн: незавершені задачі шардів скасовуються
+    _, data = await search_client.async_json(async_sessions["search"], "GET", SEARCH_URL, params=params)
+    return data
+
+async def async_google_search(query, is_premium, classification=None):
+    shard_params, cache_key = build_search_request(query, is_premium, classification)
+    cached = await asyncio.to_thread(search_cache.get, cache_key)
+    if cached is not None:
+        prefetcher.search_hit(cache_key)
+        return cached
+    tasks = [asyncio.create_task(async_search_shard(params)) for params in shard_params]
+    done, pending = await asyncio.wait(tasks, timeout=SEARCH_DEADLINE)
+    for task in pending:
+        task.cancel()
+    outcomes = []
+    for task in tasks:
+        if task not in done:
+            outcomes.append(("timeout", None))
+        elif task.exception() is not None:
+            outcomes.append(("error", task.exception()))
+        else:
+            outcomes.append(("ok", task.result()))
+    shard_items, complete, error = collect_shard_results(outcomes)
+    if error is not None:
+        print(f"❌ Помилка пошуку: {error}")
+        return f"❌ Помилка пошуку: {error}"
+    found = format_search_results(merge_search_items(shard_items), is_premium)
+    if complete:
+        await asyncio.to_thread(search_cache.set, cache_key, found)
+    return found
+
+async def async_ask_gemini(prepared):
+    cached = cached_response(prepared)
+    if cached is not None:
+        return cached
+    url, data = build_gemini_request(prepared)
+    try:
+        _, result = await gemini_client.async_json(async_sessions["gemini"], "POST", url, json=data)
+        reply = parse_gemini_reply(result or {})
+        store_response(prepared, reply)
+        return reply
+    except Exception as e:
+        return f"❌ Помилка: {e}"
+
+async def async_process_message(message):
+    with traced(message.from_user.id):
+        await async_answer_message(message)
+
+async def async_answer_message(message):
+    with span("quota"):
+        is_premium = await asyncio.to_thread(accept_message, message)
+    if is_premium is None:
+        return
+    user_id = message.from_user.id
+    with span("classification"):
+        classification = keyword_classifier.classify(message.text)
+    prepared = PreparedRequest(user_id=user_id, question=message.text, kind=classification.kind, is_premium=is_premium, classification=classification)
+    if prepared.kind == "movie":
+        with span("search"):
+            prepared.indexed_card = movie_index.lookup(message.text, is_premium) if MOVIE_INDEX else None
+            if prepared.indexed_card is None:
+                prepared.search_results = await async_google_search(message.text, is_premium, classification)
+    await asyncio.to_thread(finish_request, prepared)
     
-    if is_code_query and "```" in response:
-        user["last_code"] = response
-        bot.reply_to(message, response, parse_mode="Markdown", reply_markup=create_copy_button(response))
-    else:
-        bot.reply_to(message, response)
+    if prepared.kind == "movie":
+        remember_movie_query(user_id, message.text)
+        results_text = search_results_text(prepared)
+        if results_text:
+            await async_bot.reply_to(message, results_text, parse_mode="HTML")
+    
+    if STREAM_RESPONSES:
+        await async_stream_reply(message, prepared)
+        return
+    await async_bot.send_chat_action(message.chat.id, "typing")
+    with span("generation"):
+        response = await async_ask_gemini(prepared)
+    parse_mode, markup = await asyncio.to_thread(finalize_response, prepared, response)
+    with span("send"):
+        await async_bot.reply_to(message, response, parse_mode=parse_mode, reply_markup=markup)
+    await asyncio.to_thread(remember_exchange, prepared, response)
+
+async def async_stream_reply(message, prepared):
+    cached = cached_response(prepared)
+    if cached is not None:
+        parse_mode, markup = await asyncio.to_thread(finalize_response, prepared, cached)
+        await async_bot.reply_to(message, cached, parse_mode=parse_mode, reply_markup=markup)
+        await asyncio.to_thread(remember_exchange, prepared, cached)
+        return
+    sent = await async_bot.reply_to(message, "⏳ Генерую відповідь...")
+    editor = StreamEditor()
+    url, data = build_gemini_request(prepared, stream=True)
+    started = time.monotonic()
+    text = ""
+    with span("generation"):
+        try:
+            gemini_client.check_available()
+            async with async_sessions["gemini"].post(url, json=data) as response:
+                gemini_client.record(response.status not in UpstreamClient.RETRY_STATUSES, time.monotonic() - started)
+                async for raw_line in response.content:
+                    piece = parse_stream_line(raw_line.decode("utf-8").strip())
+                    if not piece:
+                        continue
+                    if not text:
+                        gemini_ttft.observe(time.monotonic() - started)
+                    text += piece
+                    preview = editor.next_preview(text)
+                    if preview is not None:
+                        try:
+                            await async_bot.edit_message_text(preview, sent.chat.id, sent.message_id)
+                        except Exception as e:
+                            editor.backoff(e)
+            text = text or "❌ Помилка API. Спробуйте ще раз."
+            store_response(prepared, text)
+        except UpstreamUnavailable as e:
+            text = f"❌ Помилка: {e}"
+        except Exception as e:
+            gemini_client.record(False, time.monotonic() - started)
+            text = f"❌ Помилка: {e}"
+    parse_mode, markup = await asyncio.to_thread(finalize_response, prepared, text)
+    chunks = split_message(text)
+    with span("send"):
+        try:
+            await async_bot.edit_message_text(chunks[0], sent.chat.id, sent.message_id, parse_mode=parse_mode, reply_markup=markup if len(chunks) == 1 else None)
+        except Exception:
+            await async_bot.edit_message_text(chunks[0], sent.chat.id, sent.message_id, reply_markup=markup if len(chunks) == 1 else None)
+        for i, chunk in enumerate(chunks[1:], start=2):
+            await async_bot.send_message(message.chat.id, chunk, reply_markup=markup if i == len(chunks) else None)
+    await asyncio.to_thread(remember_exchange, prepared, text)
+
+async def async_auto_save():
+    while True:
+        await asyncio.sleep(AUTOSAVE_INTERVAL)
+        await asyncio.to_thread(save_data)
+
+def webhook_app(environ, start_response):
+    """WSGI-точка входу вебхука; стан користувачів у MongoDB, тому реплік може бути кілька (напр. gunicorn bot:webhook_app)."""
+    # Під gunicorn блок __main__ не виконується — фонові служби стартують з першим запитом у кожному воркері
+    start_background_services()
+    path, method = environ.get("PATH_INFO"), environ.get("REQUEST_METHOD")
+    if path == "/healthz":
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"ok"]
+    if path != WEBHOOK_PATH or method != "POST":
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b""]
+    if WEBHOOK_SECRET and environ.get("HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN") != WEBHOOK_SECRET:
+        start_response("403 Forbidden", [("Content-Type", "text/plain")])
+        return [b""]
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        update = telebot.types.Update.de_json(environ["wsgi.input"].read(length).decode("utf-8"))
+        # TeleBot передає обробники у свій пул потоків, тож Telegram отримує відповідь одразу
+        bot.process_new_updates([update])
+    except Exception as e:
+        print(f"❌ Помилка обробки вебхука: {e}")
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"ok"]
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def render_metrics():
+    lines = ["# TYPE bot_stage_seconds histogram"]
+    for stage, histogram in stage_latency.items():
+        lines += histogram.render("bot_stage_seconds", {"stage": stage})
+    lines += ["# TYPE bot_request_seconds histogram"] + request_latency.render("bot_request_seconds")
+    lines += ["# TYPE bot_gemini_ttft_seconds histogram"] + gemini_ttft.render("bot_gemini_ttft_seconds")
+    lines += ["# TYPE bot_prompt_tokens histogram"] + prompt_tokens.render("bot_prompt_tokens")
+    lines.append("# TYPE bot_upstream_seconds histogram")
+    for client in (gemini_client, search_client):
+        lines += client.latency.render("bot_upstream_seconds", {"upstream": client.name})
+    lines.append("# TYPE bot_upstream_retries_total counter")
+    lines += [f'bot_upstream_retries_total{{upstream="{c.name}"}} {c.retries}' for c in (gemini_client, search_client)]
+    lines.append("# TYPE bot_upstream_failures_total counter")
+    lines += [f'bot_upstream_failures_total{{upstream="{c.name}"}} {c.failures}' for c in (gemini_client, search_client)]
+    lines.append("# TYPE bot_gemini_tokens_total counter")
+    lines += [f'bot_gemini_tokens_total{{type="{kind}"}} {gemini_usage[kind]}' for kind in ("prompt", "output")]
+    lines.append("# TYPE bot_cache_requests_total counter")
+    for name, cache in (("search", search_cache), ("response", response_cache), ("snippet", snippet_store)):
+        lines.append(f'bot_cache_requests_total{{cache="{name}",result="hit"}} {cache.hits}')
+        lines.append(f'bot_cache_requests_total{{cache="{name}",result="miss"}} {cache.misses}')
+    lines.append("# TYPE bot_quota_events_total counter")
+    lines += [f'bot_quota_events_total{{event="{event}"}} {quota.counters[event]}' for event in ("allowed", "quota_denied", "burst_denied", "fallback")]
+    lines.append("# TYPE bot_context_tokens_total counter")
+    lines += [f'bot_context_tokens_total{{kind="{kind}"}} {context_stats[kind]}' for kind in ("context_tokens", "skipped_tokens", "summarized_tokens")]
+    lines.append("# TYPE bot_search_shard_failures_total counter")
+    lines += [f'bot_search_shard_failures_total{{reason="{reason}"}} {search_stats["shard_" + reason]}' for reason in ("timeouts", "errors")]
+    lines.append("# TYPE bot_movie_index_lookups_total counter")
+    lines += [f'bot_movie_index_lookups_total{{result="{result}"}} {movie_index.stats[result]}' for result in ("hit", "miss", "stale")]
+    lines.append("# TYPE bot_prefetch_hits_total counter")
+    lines += [f'bot_prefetch_hits_total{{cache="{cache}"}} {prefetcher.stats[cache + "_hits"]}' for cache in ("card", "search")]
+    lines.append("# TYPE bot_queue_depth gauge")
+    lines.append(f"bot_queue_depth {dispatcher.pending if dispatcher is not None else 0}")
+    lines.append("# TYPE bot_users_cached gauge")
+    lines.append(f"bot_users_cached {len(user_data)}")
+    return "\n".join(lines) + "\n"
+
+def metrics_app(environ, start_response):
+    if environ.get("PATH_INFO") != "/metrics":
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b""]
+    start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4")])
+    return [render_metrics().encode("utf-8")]
+
+def start_metrics_server():
+    if not METRICS_PORT:
+        return
+    try:
+        server = make_server(METRICS_HOST, METRICS_PORT, metrics_app, server_class=ThreadingWSGIServer, handler_class=QuietWSGIRequestHandler)
+    except OSError as e:
+        print(f"❌ Не вдалося запустити /metrics на порту {METRICS_PORT}: {e}")
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"✅ Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+background_started = False
+background_lock = threading.Lock()
+
+def start_background_services(autosave=True):
+    """Планувальник, метрики й автозбереження; повторні виклики нічого не роблять."""
+    global background_started
+    with background_lock:
+        if background_started:
+            return
+        background_started = True
+    start_scheduler()
+    start_metrics_server()
+    if autosave:
+        start_autosave()
+
+def run_webhook_server():
+    bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    print(f"✅ Вебхук {WEBHOOK_URL + WEBHOOK_PATH}, порт {WEBHOOK_PORT}")
+    make_server("0.0.0.0", WEBHOOK_PORT, webhook_app, server_class=ThreadingWSGIServer, handler_class=QuietWSGIRequestHandler).serve_forever()
+
+async def run_async_webhook_server():
+    from aiohttp import web
+
+    tasks = set()
+
+    async def handle(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        update = telebot.types.Update.de_json(await request.text())
+        task = asyncio.create_task(async_bot.process_new_updates([update]))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.Response(text="ok")
+
+    async def health(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    app.router.add_get("/healthz", health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT).start()
+    await async_bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    print(f"✅ Вебхук {WEBHOOK_URL + WEBHOOK_PATH}, порт {WEBHOOK_PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def async_main():
+    global async_bot
+    import aiohttp
+    from telebot.async_telebot import AsyncTeleBot
+
+    async_bot = AsyncTeleBot(TELEGRAM_TOKEN)
+    for name, total_timeout in (("gemini", 25), ("search", 15)):
+        async_sessions[name] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=total_timeout)
+        )
+
+    @async_bot.message_handler(func=lambda m: True)
+    async def on_message(message):
+        if routes_to_chat(message):
+            await async_process_message(message)
+        else:
+            # Команди, меню та покрокові діалоги обробляє синхронний бот у своїх потоках
+            await asyncio.to_thread(bot.process_new_messages, [message])
+
+    @async_bot.callback_query_handler(func=lambda call: True)
+    async def on_callback(call):
+        await asyncio.to_thread(bot.process_new_callback_query, [call])
+
+    autosave_task = asyncio.create_task(async_auto_save())
+    try:
+        if WEBHOOK_URL:
+            await run_async_webhook_server()
+        else:
+            await async_bot.infinity_polling(timeout=60)
+    finally:
+        autosave_task.cancel()
+        for session in async_sessions.values():
+            await session.close()
+        await async_bot.close_session()
 
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] in ("import", "export"):
+        # python bot.py import дамп.json | python bot.py export users.jsonl
+        if sys.argv[1] == "import":
+            with open(sys.argv[2], encoding="utf-8", errors="replace") as f:
+                print(import_report(*import_dump(f)))
+        else:
+            with open(sys.argv[2], "w", encoding="utf-8") as f:
+                print(export_report(*export_users(f)))
+        save_data()
+        sys.exit(0)
     print("✅ Бот запущено з українськими сайтами та розумним пошуком!")
     print(f"📊 Користувачів у пам'яті: {len(user_data)}")
-    threading.Timer(AUTOSAVE_INTERVAL, auto_save).start()
+    # В async-режимі автозбереження веде async_auto_save у циклі подій
+    start_background_services(autosave=RUNTIME != "async")
     try:
-        bot.infinity_polling(timeout=60, long_polling_timeout=60)
+        if RUNTIME == "async":
+            print("✅ Асинхронний режим (AsyncTeleBot)")
+            asyncio.run(async_main())
+        else:
+            if DISPATCH_MODE == "pool":
+                dispatcher = MessageDispatcher(process_message, WORKER_COUNT, MAX_QUEUE_SIZE)
+                print(f"✅ Пул воркерів: {WORKER_COUNT} потоків, черга до {MAX_QUEUE_SIZE} повідомлень")
+            if WEBHOOK_URL:
+                run_webhook_server()
+            else:
+                bot.infinity_polling(timeout=60, long_polling_timeout=60)
     except Exception as e:
         print(f"❌ Критична помилка: {e}")
-        exit_handler()
\ No newline at end of file
+        exit_handler()
@@ -0,0 +1,77 @@
+"""Спільне підключення bot.py для тестів.
+
+З mongomock бот працює зі справжнім (у пам'яті) MongoDB API; без нього — у режимі без бази даних,
+а тести, яким потрібна база, пропускаються (requires_mongo).
+"""
+import json
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123:test")
+os.environ["JOURNAL_DIR"] = ""
+os.environ["METRICS_PORT"] = "0"
+os.environ.setdefault("SAVE_DEBOUNCE", "100")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pymongo
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+if mongomock is not None:
+    mongo_client = mongomock.MongoClient()
+    with mock.patch.object(pymongo, "MongoClient", return_value=mongo_client):
+        import bot
+else:
+    # Без бази: бот переходить у режим без MongoDB одразу, а не чекає таймауту підключення
+    with mock.patch.object(pymongo, "MongoClient", side_effect=Exception("no database in tests")):
+        import bot
+
+requires_mongo = unittest.skipIf(bot.users_collection is None, "потрібен mongomock")
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def gemini_reply(text):
+    return FakeResponse({"candidates": [{"content": {"parts": [{"text": text}]}}]})
+
+
+def message(user_id, text, chat_id=None):
+    from_user = types.SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Test", last_name="")
+    return types.SimpleNamespace(from_user=from_user, text=text, chat=types.SimpleNamespace(id=chat_id or user_id), message_id=1)
+
+
+def webhook_update(update_id, user_id, text):
+    """Тіло POST-запиту Telegram з текстовим повідомленням у приватному чаті."""
+    return json.dumps({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+    }}).encode()
+
+
+def reset_users():
+    """Чистий стан користувачів між тестами."""
+    with bot.dirty_lock:
+        bot.dirty_user_fields.clear()
+        bot.pending_user_incs.clear()
+        bot.pending_daily_counts.clear()
+    bot.user_data.users.clear()
+    bot.user_data.evicted.clear()
+    bot.user_data.loaded.clear()
+    if bot.users_collection is not None:
+        bot.users_collection.delete_many({})
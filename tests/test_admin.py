@@ -0,0 +1,33 @@
+import unittest
+from unittest import mock
+
+from support import bot, message, requires_mongo, reset_users
+
+
+@requires_mongo
+class FindUserTest(unittest.TestCase):
+    def setUp(self):
+        reset_users()
+
+    def find(self, query):
+        with mock.patch.object(bot.bot, "reply_to") as reply_to:
+            bot.process_find_user(message(bot.ADMIN_ID, query))
+        return reply_to.call_args[0][1]
+
+    def test_prefix_search_is_case_insensitive_via_username_lc(self):
+        user = bot.create_user(21)
+        user.username = "MovieFan"
+        bot.mark_user_dirty(21, "username")
+        bot.save_data()
+        self.assertEqual(bot.users_collection.find_one({"_id": 21})["username_lc"], "moviefan")
+        self.assertIn("MovieFan", self.find("@moviE"))
+        self.assertIn("не знайдено", self.find("fan"))
+
+    def test_backfill_fills_legacy_documents(self):
+        bot.users_collection.insert_one({"_id": 22, "username": "OldUser"})
+        bot.backfill_username_lc()
+        self.assertIn("OldUser", self.find("olduser"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import collections
+import threading
+import time
+import unittest
+from unittest import mock
+
+import telebot
+
+from support import bot, gemini_reply, message, requires_mongo, reset_users, webhook_update
+
+GEMINI_LATENCY = 0.03
+TELEGRAM_LATENCY = 0.005
+
+
+def wait_until(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("не дочекалися обробки")
+        time.sleep(0.005)
+
+
+class MessageDispatcherTest(unittest.TestCase):
+    def test_chat_order_and_one_in_flight_per_chat(self):
+        lock = threading.Lock()
+        active = collections.Counter()
+        overlaps = []
+        handled = collections.defaultdict(list)
+
+        def handler(msg):
+            with lock:
+                active[msg.chat.id] += 1
+                if active[msg.chat.id] > 1:
+                    overlaps.append(msg.chat.id)
+            time.sleep(0.002)
+            with lock:
+                active[msg.chat.id] -= 1
+                handled[msg.chat.id].append(msg.text)
+
+        dispatcher = bot.MessageDispatcher(handler, 8, 1000)
+        for i in range(20):
+            for chat_id in range(10):
+                self.assertTrue(dispatcher.submit(message(chat_id + 1, str(i))))
+        wait_until(lambda: dispatcher.processed == 200)
+        self.assertEqual(overlaps, [])
+        self.assertEqual(dict(handled), {chat_id + 1: [str(i) for i in range(20)] for chat_id in range(10)})
+        self.assertEqual((dispatcher.pending, dispatcher.chats), (0, {}))
+
+    def test_full_queue_rejects_and_handler_reports_busy(self):
+        release = threading.Event()
+        dispatcher = bot.MessageDispatcher(lambda msg: release.wait(5), 1, 2)
+        self.assertTrue(dispatcher.submit(message(1, "a")))
+        self.assertTrue(dispatcher.submit(message(2, "b")))
+        with mock.patch.object(bot, "dispatcher", dispatcher), mock.patch.object(bot.bot, "reply_to") as reply_to:
+            bot.handle_message(message(3, "c"))
+        self.assertIn("перевантажений", reply_to.call_args[0][1])
+        self.assertEqual(dispatcher.rejected, 1)
+        release.set()
+        wait_until(lambda: dispatcher.processed == 2)
+        self.assertTrue(dispatcher.submit(message(3, "c")))
+
+
+@requires_mongo
+class DispatcherLoadTest(unittest.TestCase):
+    """Навантаження: 128 чатів одночасно через пул воркерів із заглушками Telegram API та Gemini."""
+
+    CHATS = 128
+    MESSAGES_PER_CHAT = 4
+
+    def setUp(self):
+        reset_users()
+        patches = [
+            mock.patch.object(bot.bot, "reply_to", side_effect=lambda *args, **kwargs: time.sleep(TELEGRAM_LATENCY)),
+            mock.patch.object(bot.bot, "send_chat_action", side_effect=lambda *args, **kwargs: time.sleep(TELEGRAM_LATENCY)),
+            mock.patch.object(bot.gemini_client, "request", side_effect=self.fake_gemini),
+            mock.patch.object(bot, "STREAM_RESPONSES", False),
+            mock.patch.object(bot, "BOT_ENABLED", True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def fake_gemini(self, *args, **kwargs):
+        time.sleep(GEMINI_LATENCY)
+        return gemini_reply("Привіт!")
+
+    def test_latency_under_concurrent_chats(self):
+        latency = bot.Histogram()
+        submitted = {}
+
+        def handler(msg):
+            bot.process_message(msg)
+            latency.observe(time.monotonic() - submitted[msg.message_id])
+
+        total = self.CHATS * self.MESSAGES_PER_CHAT
+        dispatcher = bot.MessageDispatcher(handler, bot.WORKER_COUNT, total)
+        update_id = 0
+        for i in range(self.MESSAGES_PER_CHAT):
+            for chat_id in range(50_000, 50_000 + self.CHATS):
+                update_id += 1
+                msg = telebot.types.Update.de_json(webhook_update(update_id, chat_id, f"розкажи щось цікаве {update_id}").decode()).message
+                submitted[msg.message_id] = time.monotonic()
+                self.assertTrue(dispatcher.submit(msg))
+        wait_until(lambda: dispatcher.processed == total, timeout=60)
+        self.assertEqual(bot.gemini_client.request.call_count, total)
+        p50, p99 = latency.percentile(50), latency.percentile(99)
+        print(f"\n{self.CHATS} чатів × {self.MESSAGES_PER_CHAT}, {bot.WORKER_COUNT} воркерів: p50 {p50}с, p99 {p99}с")
+        # Послідовно це 512 × ~40 мс ≈ 20 с; пул із WORKER_COUNT воркерів має вкластися в кілька секунд
+        self.assertLessEqual(p99, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import io
+import json
+import unittest
+
+from support import bot, requires_mongo, reset_users
+
+
+@requires_mongo
+class ExportUsersTest(unittest.TestCase):
+    def setUp(self):
+        reset_users()
+
+    def test_non_numeric_ids_are_skipped_and_reported(self):
+        bot.users_collection.insert_many([
+            {"_id": 5, "used": 1},
+            {"_id": "7", "used": 2},
+            {"_id": "broken", "used": 3},
+        ])
+        out = io.StringIO()
+        count, errors = bot.export_users(out)
+        self.assertEqual(count, 2)
+        self.assertEqual(sorted(json.loads(line)["_id"] for line in out.getvalue().splitlines()), [5, 7])
+        self.assertEqual(len(errors), 1)
+        self.assertIn("'broken'", errors[0])
+        self.assertIn("Пропущено записів: 1", bot.export_report(count, errors))
+
+    def test_export_round_trips_through_import(self):
+        bot.users_collection.insert_one({"_id": 9, "used": 4, "history": [{"role": "user", "text": "привіт"}]})
+        out = io.StringIO()
+        bot.export_users(out)
+        bot.users_collection.delete_many({})
+        stats, errors = bot.import_dump(io.StringIO(out.getvalue()))
+        self.assertEqual((stats["imported"], errors), (1, []))
+        self.assertEqual(bot.users_collection.find_one({"_id": 9})["history"], [{"role": "user", "text": "привіт"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
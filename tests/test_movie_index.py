@@ -0,0 +1,28 @@
+import unittest
+
+from support import bot
+
+THOR_CARD = "🎬 Назва: Тор (Thor)\n📅 Рік: 2011\n⭐ Рейтинг: 7.0"
+DUNE_CARD = "🎬 Назва: Дюна (Dune)\n📅 Рік: 2021\n⭐ Рейтинг: 8.0"
+
+
+class MovieIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = bot.MovieIndex(None, 100, bot.MOVIE_INDEX_MIN_SCORE)
+        self.index.record("фільм Тор", False, THOR_CARD)
+        self.index.record("фільм Дюна", False, DUNE_CARD)
+
+    def test_short_titles_need_exact_match(self):
+        self.assertEqual(self.index.lookup("фільм Тор", False), THOR_CARD)
+        self.assertEqual(self.index.lookup("фільм Thor", False), THOR_CARD)
+        self.assertIsNone(self.index.lookup("фільм Торі", False))
+        self.assertIsNone(self.index.lookup("фільм То", False))
+
+    def test_longer_titles_still_match_fuzzily(self):
+        self.assertEqual(self.index.lookup("фільм Дюнна", False), DUNE_CARD)
+        self.assertEqual(self.index.lookup("Дюна 2021", False), DUNE_CARD)
+        self.assertIsNone(self.index.lookup("Дюна 2", False))
+
+
+if __name__ == "__main__":
+    unittest.main()
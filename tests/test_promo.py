@@ -0,0 +1,53 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from support import bot, requires_mongo
+
+REDEEMERS = 1000
+USES = 100
+
+
+@requires_mongo
+class PromoRedeemLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.codes = bot.db["test_promo_codes"]
+        self.redemptions = bot.db["test_promo_redemptions"]
+        self.codes.delete_many({})
+        self.redemptions.delete_many({})
+        self.store = bot.PromoStore(self.codes, self.redemptions, {})
+        self.store.add("LOAD", 3600, USES)
+
+    def redeem_all(self, user_ids):
+        with ThreadPoolExecutor(64) as pool:
+            return [status for status, _ in pool.map(lambda user_id: self.store.redeem("LOAD", user_id), user_ids)]
+
+    def test_concurrent_redeemers_never_over_redeem(self):
+        statuses = self.redeem_all(range(REDEEMERS))
+        self.assertEqual(statuses.count("ok"), USES)
+        self.assertEqual(statuses.count("exhausted"), REDEEMERS - USES)
+        self.assertEqual(self.codes.find_one({"_id": "LOAD"})["uses_left"], 0)
+        # Погашення лишаються лише в тих, хто справді отримав преміум
+        self.assertEqual(self.redemptions.count_documents({"code": "LOAD"}), USES)
+
+    def test_same_user_redeems_once(self):
+        statuses = self.redeem_all([42] * 200)
+        self.assertEqual(statuses.count("ok"), 1)
+        self.assertEqual(statuses.count("used"), 199)
+        self.assertEqual(self.codes.find_one({"_id": "LOAD"})["uses_left"], USES - 1)
+
+    def test_failed_inc_rolls_back_redemption(self):
+        with mock.patch.object(self.codes, "find_one_and_update", side_effect=Exception("write conflict")):
+            with self.assertRaises(Exception):
+                self.store.redeem("LOAD", 7)
+        self.assertIsNone(self.redemptions.find_one({"_id": "LOAD:7"}))
+        self.assertEqual(self.store.redeem("LOAD", 7), ("ok", 3600))
+        self.assertEqual(self.codes.find_one({"_id": "LOAD"})["uses_left"], USES - 1)
+
+    def test_unknown_code_is_invalid(self):
+        self.assertEqual(self.store.redeem("NOPE", 1), ("invalid", None))
+        self.assertEqual(self.redemptions.count_documents({}), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
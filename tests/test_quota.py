@@ -0,0 +1,80 @@
+import datetime
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from support import bot, requires_mongo, reset_users
+
+REQUESTS = 100
+
+
+@requires_mongo
+class QuotaLimiterTest(unittest.TestCase):
+    def setUp(self):
+        reset_users()
+        self.quota = bot.QuotaLimiter(bot.FREE_LIMIT, 0, 60)
+        patch = mock.patch.object(bot, "QUOTA_ATOMIC", True)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def consume_concurrently(self, user):
+        with ThreadPoolExecutor(32) as pool:
+            return list(pool.map(lambda _: self.quota.consume(user), range(REQUESTS)))
+
+    def stored_used(self, user_id):
+        return bot.users_collection.find_one({"_id": user_id})["used"]
+
+    def test_concurrent_consume_allows_exactly_the_limit(self):
+        user = bot.create_user(1)
+        bot.save_data()
+        allowed = self.consume_concurrently(user)
+        self.assertEqual(allowed.count(True), bot.FREE_LIMIT)
+        self.assertEqual(self.stored_used(1), bot.FREE_LIMIT)
+        self.assertEqual(self.quota.counters["fallback"], 0)
+
+    def test_concurrent_first_requests_of_the_day(self):
+        user = bot.create_user(2)
+        bot.save_data()
+        yesterday = (datetime.date.fromordinal(bot.current_day()) - datetime.timedelta(days=1)).isoformat()
+        bot.users_collection.update_one({"_id": 2}, {"$set": {"used": bot.FREE_LIMIT, "reset": yesterday}})
+        user.reset -= 1
+        allowed = self.consume_concurrently(user)
+        self.assertEqual(allowed.count(True), bot.FREE_LIMIT)
+        self.assertEqual(self.stored_used(2), bot.FREE_LIMIT)
+
+    def test_day_rolled_by_another_request_between_queries(self):
+        user = bot.create_user(4)
+        bot.save_data()
+        today = datetime.date.fromordinal(bot.current_day())
+        bot.users_collection.update_one({"_id": 4}, {"$set": {"reset": (today - datetime.timedelta(days=1)).isoformat()}})
+        user.reset -= 1
+        collection = bot.users_collection
+        original = collection.find_one_and_update
+        calls = []
+
+        def racing_update(query, update, **kwargs):
+            calls.append(query)
+            if len(calls) == 2:
+                # Між нашими запитами інший встигає першим скинути лічильник нової доби
+                original({"_id": 4}, {"$set": {"used": 1, "reset": today.isoformat()}})
+            return original(query, update, **kwargs)
+
+        with mock.patch.object(collection, "find_one_and_update", side_effect=racing_update):
+            self.assertTrue(self.quota.consume(user))
+        self.assertEqual(self.stored_used(4), 2)
+
+    def test_new_user_falls_back_to_local_count_before_first_flush(self):
+        user = bot.create_user(3)
+        self.assertIsNone(bot.users_collection.find_one({"_id": 3}))
+        allowed = [self.quota.consume(user) for _ in range(bot.FREE_LIMIT + 1)]
+        self.assertEqual(allowed, [True] * bot.FREE_LIMIT + [False])
+        self.assertEqual(self.quota.counters["fallback"], bot.FREE_LIMIT + 1)
+        bot.save_data()
+        self.assertEqual(self.stored_used(3), bot.FREE_LIMIT)
+        # Після першого запису списання знову атомарне
+        self.assertFalse(self.quota.consume(user))
+        self.assertEqual(self.quota.counters["fallback"], bot.FREE_LIMIT + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import datetime
+import unittest
+from unittest import mock
+
+from support import bot, requires_mongo, reset_users
+
+# 12:00 за Києвом, 1 березня 2025
+START = bot.UKRAINE_TZ.localize(datetime.datetime(2025, 3, 1, 12, 0)).timestamp()
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@requires_mongo
+class SchedulerClockTest(unittest.TestCase):
+    def setUp(self):
+        reset_users()
+        self.clock = FakeClock(START)
+        self.scheduler = bot.Scheduler(self.clock)
+        patch = mock.patch.object(bot, "scheduler", self.scheduler)
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = mock.patch.object(bot.bot, "send_message")
+        self.notify = patch.start()
+        self.addCleanup(patch.stop)
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        return self.scheduler.run_pending()
+
+    def grant(self, user_id, seconds):
+        user = bot.user_data.get(user_id) or bot.create_user(user_id)
+        base = user.premium_until if user.premium_active else datetime.datetime.fromtimestamp(self.clock(), bot.UKRAINE_TZ)
+        user.set_premium(True, base + datetime.timedelta(seconds=seconds))
+        bot.mark_user_dirty(user_id, "premium")
+        bot.schedule_premium_expiry(user)
+        bot.save_data()
+        return user
+
+    def stored_premium(self, user_id):
+        return bot.users_collection.find_one({"_id": user_id})["premium"]["active"]
+
+    def test_premium_expires_when_clock_passes_until(self):
+        user = self.grant(1, 3600)
+        self.advance(3599)
+        self.assertTrue(user.premium_active)
+        self.advance(1)
+        self.assertFalse(user.premium_active)
+        self.assertFalse(self.stored_premium(1))
+        self.assertEqual(self.notify.call_count, 1)
+
+    def test_extension_cancels_old_expiry(self):
+        user = self.grant(2, 3600)
+        self.advance(1800)
+        self.grant(2, 3600)
+        # Стара задача спрацьовує в першу годину, але преміум уже продовжено
+        self.advance(1800)
+        self.assertTrue(user.premium_active)
+        self.assertTrue(self.stored_premium(2))
+        self.notify.assert_not_called()
+        self.advance(3600)
+        self.assertFalse(user.premium_active)
+        self.assertEqual(self.notify.call_count, 1)
+
+    def test_midnight_resets_daily_quota(self):
+        user = bot.create_user(3)
+        user.used = 5
+        bot.mark_user_dirty(3, "used")
+        bot.save_data()
+        midnight = bot.next_midnight(self.clock())
+        self.scheduler.schedule(midnight, bot.reset_daily_quotas)
+        self.clock.now = midnight - 1
+        self.scheduler.run_pending()
+        self.assertEqual(user.used, 5)
+        next_run = self.advance(1)
+        self.assertEqual(user.used, 0)
+        self.assertEqual(user.reset, bot.current_day())
+        self.assertEqual(bot.users_collection.find_one({"_id": 3})["used"], 0)
+        # Наступне скидання заплановано на наступну північ (24 години за Києвом)
+        self.assertEqual(next_run, midnight + 86400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+from support import FakeResponse, bot, gemini_reply, message, reset_users
+
+
+class MovieMessageSearchTest(unittest.TestCase):
+    """Повідомлення про фільм: класифікація, пошук і промпт виконуються один раз на запит."""
+
+    def setUp(self):
+        reset_users()
+        self.search_calls = []
+        patches = [
+            mock.patch.object(bot.search_client, "request", side_effect=self.fake_search),
+            mock.patch.object(bot.gemini_client, "request", return_value=gemini_reply("🎬 Назва: Тест\n📅 Рік випуску: 2001")),
+            mock.patch.object(bot, "bot", mock.MagicMock()),
+            mock.patch.object(bot, "search_cache", bot.TTLCache(10, 60)),
+            mock.patch.object(bot, "response_cache", bot.TTLCache(10, 60)),
+            mock.patch.object(bot, "MOVIE_INDEX", False),
+            mock.patch.object(bot, "STREAM_RESPONSES", False),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def fake_search(self, method, url, **kwargs):
+        self.search_calls.append(kwargs["params"]["q"])
+        return FakeResponse({"items": [{"title": "Тест", "link": "https://kinoukr.com/test"}]})
+
+    def test_single_search_call_without_fanout(self):
+        with mock.patch.object(bot, "SEARCH_FANOUT", False):
+            bot.answer_message(message(101, "фільм про космос"))
+        self.assertEqual(len(self.search_calls), 1)
+
+    def test_one_call_per_shard_with_fanout(self):
+        with mock.patch.object(bot, "SEARCH_FANOUT", True):
+            bot.answer_message(message(102, "фільм про космос"))
+        self.assertEqual(len(self.search_calls), len(bot.MOVIE_SITE_SHARDS))
+        self.assertEqual(len(set(self.search_calls)), len(bot.MOVIE_SITE_SHARDS))
+
+    def test_general_message_does_not_search(self):
+        bot.answer_message(message(103, "привіт, як справи?"))
+        self.assertEqual(self.search_calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import io
+import json
+import unittest
+from unittest import mock
+
+import requests
+
+from support import bot
+
+
+def sse_response(*pieces):
+    body = "".join(f"data: {json.dumps({'candidates': [{'content': {'parts': [{'text': piece}]}}]}, ensure_ascii=False)}\n\n" for piece in pieces)
+    response = requests.Response()
+    response.status_code = 200
+    # Як у Gemini: text/event-stream без charset
+    response.headers["Content-Type"] = "text/event-stream"
+    response.raw = io.BytesIO(body.encode("utf-8"))
+    return response
+
+
+class StreamGeminiTest(unittest.TestCase):
+    def test_cyrillic_chunks_are_decoded_as_utf8(self):
+        prepared = bot.PreparedRequest(user_id=1, question="привіт", kind="general", is_premium=False)
+        previews = []
+        with mock.patch.object(bot.gemini_client, "request", return_value=sse_response("Прив", "іт, світе!")):
+            text = bot.stream_gemini(prepared, previews.append)
+        self.assertEqual(text, "Привіт, світе!")
+        self.assertEqual(previews, ["Прив", "Привіт, світе!"])
+
+
+if __name__ == "__main__":
+    unittest.main()
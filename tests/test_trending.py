@@ -0,0 +1,41 @@
+import unittest
+from unittest import mock
+
+from support import bot, requires_mongo
+
+
+class TrendingQueriesTest(unittest.TestCase):
+    def test_local_counts_by_normalized_title(self):
+        trending = bot.TrendingQueries(None, 3)
+        for text in ("фільм Дюна", "фільм дюна", "Дюна фільм", "фільм Аватар"):
+            trending.observe(text)
+        self.assertEqual(trending.top(5), [("diuna", "Дюна фільм", 3), ("avatar", "фільм Аватар", 1)])
+
+    @requires_mongo
+    def test_flush_drops_samples_and_aggregates_in_mongo(self):
+        collection = bot.db["test_movie_queries"]
+        collection.delete_many({})
+        trending = bot.TrendingQueries(collection, 3)
+        trending.observe("фільм дюна")
+        trending.observe("фільм Дюна")
+        trending.flush()
+        self.assertEqual(trending.pending, {})
+        trending.observe("фільм дюна")
+        trending.flush()
+        self.assertEqual(trending.top(5), [("diuna", "фільм дюна", 3)])
+
+    @requires_mongo
+    def test_failed_flush_keeps_counts(self):
+        collection = bot.db["test_movie_queries"]
+        collection.delete_many({})
+        trending = bot.TrendingQueries(collection, 3)
+        trending.observe("фільм дюна")
+        with mock.patch.object(collection, "bulk_write", side_effect=Exception("down")):
+            trending.flush()
+        trending.observe("фільм дюна")
+        trending.flush()
+        self.assertEqual(trending.top(5), [("diuna", "фільм дюна", 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
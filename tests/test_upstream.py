@@ -0,0 +1,71 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from support import FakeResponse, bot, gemini_reply
+
+
+class FakeAiohttpResponse:
+    def __init__(self, status, data, headers=None):
+        self.status = status
+        self.data = data
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def json(self, content_type=None):
+        return self.data
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+class UpstreamRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.client = bot.UpstreamClient("Test", 5)
+
+    def test_sync_request_retries_transient_status(self):
+        busy = FakeResponse({})
+        busy.status_code, busy.headers = 503, {"Retry-After": "0"}
+        with mock.patch.object(self.client.session, "request", side_effect=[busy, FakeResponse({"ok": True})]) as request:
+            response = self.client.request("GET", "https://example.invalid")
+        self.assertEqual(response.json(), {"ok": True})
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(self.client.retries, 1)
+
+    def test_async_json_retries_429_with_retry_after(self):
+        session = FakeSession(
+            FakeAiohttpResponse(429, {"error": "rate"}, {"Retry-After": "0"}),
+            FakeAiohttpResponse(200, {"ok": True}),
+        )
+        status, data = asyncio.run(self.client.async_json(session, "GET", "https://example.invalid"))
+        self.assertEqual((status, data), (200, {"ok": True}))
+        self.assertEqual(session.calls, 2)
+
+    def test_async_json_returns_last_status_after_retries(self):
+        session = FakeSession(*[FakeAiohttpResponse(503, {"error": "down"}, {"Retry-After": "0"}) for _ in range(3)])
+        status, data = asyncio.run(self.client.async_json(session, "GET", "https://example.invalid", max_retries=2))
+        self.assertEqual((status, data), (503, {"error": "down"}))
+        self.assertEqual(session.calls, 3)
+
+    def test_async_gemini_answer_survives_transient_503(self):
+        reply = gemini_reply("Привіт!").json()
+        session = FakeSession(FakeAiohttpResponse(503, {}, {"Retry-After": "0"}), FakeAiohttpResponse(200, reply))
+        prepared = bot.PreparedRequest(user_id=1, question="привіт", kind="code", is_premium=False)
+        with mock.patch.dict(bot.async_sessions, {"gemini": session}), mock.patch.object(bot, "gemini_client", self.client):
+            self.assertEqual(asyncio.run(bot.async_ask_gemini(prepared)), "Привіт!")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import io
+import queue
+import threading
+import time
+import unittest
+from unittest import mock
+
+from support import bot, gemini_reply, requires_mongo, reset_users, webhook_update
+
+GEMINI_LATENCY = 0.03
+TELEGRAM_LATENCY = 0.005
+
+
+def post_update(body):
+    environ = {"PATH_INFO": bot.WEBHOOK_PATH, "REQUEST_METHOD": "POST", "CONTENT_LENGTH": str(len(body)), "wsgi.input": io.BytesIO(body)}
+    status = []
+    bot.webhook_app(environ, lambda code, headers: status.append(code))
+    return status[0]
+
+
+@requires_mongo
+class ConversationAcrossReplicasTest(unittest.TestCase):
+    """Дві репліки вебхука з власними кешами користувачів і спільною базою."""
+
+    def setUp(self):
+        reset_users()
+        patches = [
+            mock.patch.object(bot, "USER_CACHE_TTL", 30),
+            mock.patch.object(bot, "SUMMARIZE_WITH_GEMINI", False),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        bot.create_user(7)
+        bot.save_data()
+
+    def exchange(self, question, answer):
+        prepared = bot.finish_request(bot.PreparedRequest(user_id=7, question=question, kind="general", is_premium=False))
+        bot.remember_exchange(prepared, answer)
+        return prepared
+
+    def test_turns_from_other_replica_are_kept(self):
+        self.exchange("питання 1", "відповідь 1")
+        replica_b = bot.UserRepository(bot.USER_CACHE_SIZE)
+        with mock.patch.object(bot, "user_data", replica_b):
+            self.exchange("питання 2", "відповідь 2")
+        # Репліка A все ще тримає в кеші лише першу пару
+        prepared = self.exchange("питання 3", "відповідь 3")
+        context = " ".join(turn["parts"][0]["text"] for turn in prepared.context)
+        self.assertIn("питання 2", context)
+        stored = [turn["text"] for turn in bot.users_collection.find_one({"_id": 7})["history"]]
+        self.assertEqual(stored, ["питання 1", "відповідь 1", "питання 2", "відповідь 2", "питання 3", "відповідь 3"])
+
+
+class WebhookThroughputTest(unittest.TestCase):
+    """Демонстрація масштабування: N воркерів WSGI проти заглушок Telegram API та Gemini.
+
+    Воркери тут — потоки одного процесу (mongomock не ділиться між процесами); кожен обробляє
+    оновлення синхронно, як воркер gunicorn.
+    """
+
+    UPDATES = 64
+
+    def setUp(self):
+        reset_users()
+        patches = [
+            mock.patch.object(bot, "start_background_services"),
+            mock.patch.object(bot.bot, "threaded", False),
+            mock.patch.object(bot.bot, "reply_to", side_effect=lambda *args, **kwargs: time.sleep(TELEGRAM_LATENCY)),
+            mock.patch.object(bot.bot, "send_chat_action", side_effect=lambda *args, **kwargs: time.sleep(TELEGRAM_LATENCY)),
+            mock.patch.object(bot.gemini_client, "request", side_effect=self.fake_gemini),
+            mock.patch.object(bot, "STREAM_RESPONSES", False),
+            mock.patch.object(bot, "BOT_ENABLED", True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def fake_gemini(self, *args, **kwargs):
+        time.sleep(GEMINI_LATENCY)
+        return gemini_reply("Привіт!")
+
+    def run_workers(self, workers, first_user):
+        updates = queue.Queue()
+        for i in range(self.UPDATES):
+            updates.put(webhook_update(first_user + i, first_user + i, f"привіт {first_user + i}"))
+        statuses = []
+
+        def worker():
+            while True:
+                try:
+                    body = updates.get_nowait()
+                except queue.Empty:
+                    return
+                statuses.append(post_update(body))
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        self.assertEqual(statuses, ["200 OK"] * self.UPDATES)
+        return self.UPDATES / elapsed
+
+    def test_throughput_scales_with_workers(self):
+        results = {workers: self.run_workers(workers, 10_000 * workers) for workers in (1, 4, 8)}
+        print("\n" + "\n".join(f"{workers} воркер(ів): {rate:.0f} оновлень/с" for workers, rate in results.items()))
+        self.assertGreater(results[8], results[1] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()